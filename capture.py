@@ -0,0 +1,119 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Dict, List, Optional
+
+import pdu
+
+# directions a PDU can travel, relative to the server
+DIRECTION_IN = "in"
+DIRECTION_OUT = "out"
+
+# what LOGIN_REQUEST passwords are replaced with in the capture file. replays need real
+# passwords, those come from an accounts file instead (see replay.py)
+REDACTED_PASSWORD = "<redacted>"
+
+# captured lines are written out in batches, at most FLUSH_INTERVAL seconds after they were
+# captured or as soon as FLUSH_LINES of them are waiting, whichever comes first
+FLUSH_INTERVAL = 0.5
+FLUSH_LINES = 1000
+
+# what a PDU is stored as: its JSON as an object, or as text if it isn't JSON
+def decode_pdu(data: bytes):
+    text = data.decode("utf-8", errors="replace")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+# blanks out the password of a decoded LOGIN_REQUEST so captures don't end up holding
+# credentials. anything else is returned untouched
+def redact(message):
+    if not isinstance(message, dict) or message.get("mtype") != pdu.LOGIN_REQUEST:
+        return message
+    payload = message.get("payload")
+    if not isinstance(payload, dict) or "password" not in payload:
+        return message
+    return dict(message, payload=dict(payload, password=REDACTED_PASSWORD))
+
+# records every PDU the server sees into an append-only JSON Lines file, one line per PDU:
+# {"t": timestamp, "c": connection id, "s": stream id, "d": "in"/"out", "g": datagram?, "p": pdu}
+# plus "r", the stream the PDU answers, when the server sent it on a different stream
+# (bulk payloads go out on their own stream)
+# login passwords are redacted before they're written.
+# record() only queues the line, the writes happen in batches on a thread of their own so
+# a slow disk never holds up the event loop. close() writes out whatever is left
+class TrafficCapture:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8")
+        self.pending: List[str] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # one thread, so batches reach the file in the order they were captured
+        self.writer = ThreadPoolExecutor(max_workers=1)
+
+    def record(self, conn_id: int, stream_id: Optional[int], direction: str,
+               data: bytes, datagram: bool = False, reply_to: Optional[int] = None) -> None:
+        if self.file is None:
+            return
+        record = {
+            "t": round(time(), 6),
+            "c": conn_id,
+            "s": stream_id,
+            "d": direction,
+            "g": datagram,
+            "p": redact(decode_pdu(data))
+        }
+        if reply_to is not None and reply_to != stream_id:
+            record["r"] = reply_to
+        self.pending.append(json.dumps(record, separators=(",", ":")) + "\n")
+
+        if len(self.pending) >= FLUSH_LINES:
+            self.flush()
+        elif self.flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self.flush_handle = loop.call_later(FLUSH_INTERVAL, self.flush)
+
+    # hands everything captured so far to the writer thread
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending or self.file is None:
+            return
+        lines = "".join(self.pending)
+        self.pending = []
+        self.writer.submit(self._write, lines)
+
+    def _write(self, lines: str) -> None:
+        self.file.write(lines)
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        self.flush()
+        self.writer.shutdown(wait=True)
+        self.file.close()
+        self.file = None
+
+# reads a capture file back and groups the records by connection, keeping them in the
+# order they were written. blank or truncated lines (e.g. from a crash mid write) are skipped
+def load_capture(path: str) -> Dict[int, List[dict]]:
+    connections: Dict[int, List[dict]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            connections.setdefault(record["c"], []).append(record)
+    return connections
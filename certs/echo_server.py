@@ -1,4 +1,4 @@
-import asyncio
+import random
 from typing import Coroutine,Dict
 import json
 from echo_quic import EchoQuicConnection, QuicStreamEvent
@@ -10,6 +10,20 @@ id_tracker = 1
 users = set()
 SERVER_SUPPORTED_VERSIONS = ["1.2", "1.1", "1.0"]
 
+# accounts that are allowed to login, username -> password
+CREDENTIALS = {
+    "user1": "pass1",
+    "user2": "pass2"
+}
+
+# adds the accounts in a JSON file ({"username": "password", ...}) to CREDENTIALS, e.g. so
+# every copy of a replayed connection can login with its own account
+def load_credentials(path):
+    with open(path, "r", encoding="utf-8") as f:
+        accounts = json.load(f)
+    CREDENTIALS.update(accounts)
+    return accounts
+
 # Allows server to access client states
 class ClientStateForServer:
     DISCONNECTED = "DISCONNECTED"
@@ -36,12 +50,56 @@ class ClientSession:
         print(f"[svr] Client {self.id} transitioning from {self.state} to {new_state}")
         self.state = new_state
 
+# sends a PDU tagged with its delivery channel and priority class, so the sending side
+# doesn't have to decode it again to find out
+async def send_pdu(conn, stream_id, message):
+    await conn.send(message.to_event(stream_id))
+
 # A way for the server to send error messages to specific client
 async def send_error(conn, stream_id, client_id, error_code, message):
     error_msg = pdu.error_message(client_id, error_code, message)
-    await conn.send(QuicStreamEvent(stream_id, error_msg.to_bytes(), False))
+    await send_pdu(conn, stream_id, error_msg)
     print(f"[svr] Sent error {error_code} to client {client_id}: {message}")
 
+# Used when the server is shutting down, tells the client to come back after delay_ms plus
+# a random share of window_ms, so every client doesn't reconnect at the same moment
+async def send_reconnect(conn, stream_id, scope, delay_ms, window_ms):
+    client_id = scope.get("client_id") or -1
+    reconnect_after = delay_ms + random.randint(0, window_ms)
+    await send_pdu(conn, stream_id, pdu.reconnect_message(client_id, reconnect_after, window_ms))
+    print(f"[svr] Told client {client_id} to reconnect after {reconnect_after} ms")
+
+# the connection this scope belongs to is gone, so whoever was logged in on it is too.
+# safe to call more than once, only the first call finds the session
+def end_session(scope):
+    current_client_id = scope.get("client_id")
+    scope["client_id"] = None
+    if current_client_id and current_client_id in clients:
+        print(f"[svr] Client {current_client_id} disconnected unexpectedly")
+        session = clients[current_client_id]
+        users.discard(session.username)
+        session.transition_state(ClientStateForServer.DISCONNECTED)
+        del clients[current_client_id]
+
+# datagrams aren't on any stream, so they're handled here against the connection's scope
+# instead of by a stream's echo_server_proto. only pings go out that way (pdu.DELIVERY_POLICY)
+# and they don't get a reply
+def handle_datagram(scope, data):
+    try:
+        message = pdu.Message.from_bytes(data)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"[svr] Unreadable datagram: {e}")
+        return
+
+    if message.mtype == pdu.PING_MESSAGE:
+        client_id = message.payload.get("id")
+        if client_id in clients and client_id == scope.get("client_id"):
+            session = clients[client_id]
+            session.change_activity()
+            print(f"[svr] Ping received from client {session.username}")
+    else:
+        print("[svr] Ignoring datagram of type:", message.mtype)
+
 # Proposal detailed a timeout for clients, this method checks that clients have not disappeared
 # after 300 seconds
 async def remove_inactive_clients():
@@ -70,6 +128,8 @@ async def remove_inactive_clients():
         del clients[client_id]
 
 # the main builk of the code
+# runs once per stream, but scope is shared by every stream on the same connection,
+# so the logged in client id lives there (scope["client_id"]) and not in the stream
 async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
     # create new session id for each client starting at 1
     global id_tracker
@@ -79,29 +139,34 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
     # while loop for chatting
     try:
         while True:
-            # this part checks if any clients are idling / disconnected somehow
+            # this part checks if the client disconnected somehow
             # this is necessary because if a client disconnects the server needs to know
             # so the client can try to login again and not get the 
-            # LOGIN_FROM_OTHER_LOCATION error message
+            # LOGIN_FROM_OTHER_LOCATION error message. when the connection goes away
+            # we get None instead of a message
             try:
-                message:QuicStreamEvent = await asyncio.wait_for(conn.receive(), timeout=1.0)
+                message:QuicStreamEvent = await conn.receive()
                 if message is None:
                     raise ConnectionResetError("Connection closed by client")
-            except asyncio.TimeoutError:
-                continue
             # we had a connection time out here, perhaps by using ctrl+c
             except Exception as e:
                 print(f"[svr] Connection error: {e}")
-                if current_client_id and current_client_id in clients:
-                    print(f"[svr] Client {current_client_id} disconnected unexpectedly")
-                    session = clients[current_client_id]
-                    users.discard(session.username)
-                    session.transition_state(ClientStateForServer.DISCONNECTED)
-                    del clients[current_client_id]
+                end_session(scope)
                 break
 
-            # read the message from the client
-            dgram_in = pdu.Message.from_bytes(message.data)
+            # an empty FIN just closes the stream, there is nothing to read
+            if not message.data:
+                if message.end_stream:
+                    break
+                continue
+
+            # read the message from the client. one we can't read ends this stream only,
+            # the client is still logged in on the rest of the connection
+            try:
+                dgram_in = pdu.Message.from_bytes(message.data)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"[svr] Unreadable message on stream {message.stream_id}: {e}")
+                break
             print("[svr] received message type: ", dgram_in.mtype)
             print("[svr] received message: ", dgram_in.payload)
             stream_id = message.stream_id
@@ -119,17 +184,17 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
                         selected_version = version
                         print(f"[svr] Agreed on version {selected_version}")
                         response = pdu.version_response(selected_version, True)
-                        await conn.send(QuicStreamEvent(stream_id, response.to_bytes(), False))
+                        await send_pdu(conn, stream_id, response)
                         break
                 else:
                     print(f"[svr] No compatible version found with client")
-                    await conn.send(QuicStreamEvent(stream_id, pdu.error_unsupported_version().to_bytes(), False))
+                    await send_pdu(conn, stream_id, pdu.error_unsupported_version())
                     break
 
 
             # checks if the message is a LOGIN_REQUEST
             # authenticates the user
-            # currently hardcoded in 2 users, user1 and user2
+            # accounts come from CREDENTIALS, by default just user1 and user2
             # assigns ID after login
             elif dgram_in.mtype == pdu.LOGIN_REQUEST:
                 username = dgram_in.payload.get("username")
@@ -143,13 +208,14 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
                     continue
 
                 # credential checker, and assign new id to verified login
-                if (username == "user1" and password == "pass1") or (username == "user2" and password == "pass2"):
+                if username in CREDENTIALS and CREDENTIALS[username] == password:
                     auth = 0
                     current_client_id = id_tracker
 
                     session = ClientSession(current_client_id, conn, username)
                     session.transition_state(ClientStateForServer.AUTHENTICATED)
                     clients[current_client_id] = session
+                    scope["client_id"] = current_client_id
                     users.add(username)
                     id_tracker += 1
 
@@ -162,7 +228,7 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
 
                 # send the response back to client
                 response = pdu.login_response(auth, current_client_id)
-                await conn.send(QuicStreamEvent(stream_id, response.to_bytes(), False))
+                await send_pdu(conn, stream_id, response)
         
             # if the message is a chat_message
             # get the client's id and the chat message
@@ -184,7 +250,7 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
                 print(f"[svr] Chat from {session.username}: {chat_msg}")
                 
                 # parrot back chat to client
-                await conn.send(QuicStreamEvent(stream_id, dgram_in.to_bytes(), False))
+                await send_pdu(conn, stream_id, dgram_in)
 
             # logout message for when client does !exit or !quit
             elif dgram_in.mtype == pdu.LOGOUT_MESSAGE:
@@ -199,7 +265,9 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
                     del clients[client_id]
                 else:
                     print(f"[svr] Logout request for unknown client {client_id}")
-            
+
+                if scope.get("client_id") == client_id:
+                    scope["client_id"] = None
                 break
 
             # error messages for error handling
@@ -218,6 +286,8 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
                         users.discard(session.username)
                         session.transition_state(ClientStateForServer.DISCONNECTED)
                         del clients[client_id]
+                        if scope.get("client_id") == client_id:
+                            scope["client_id"] = None
                         break
 
             # checks for PING MESSAGES
@@ -234,11 +304,17 @@ async def echo_server_proto(scope:Dict, conn:EchoQuicConnection):
             else:
                 print("[svr] Ignoring unknown message:", dgram_in.mtype)
 
+            # the client is done with this stream, so we are too
+            if message.end_stream:
+                break
+
     # handles any exceptions that rise up in the server protocol
     # disconnects the user
     except Exception as e:
         print(f"[svr] Exception in server protocol: {e}")
 
+        current_client_id = scope.get("client_id")
+        scope["client_id"] = None
         if current_client_id and current_client_id in clients:
             session = clients[current_client_id]
             users.discard(session.username)
@@ -3,6 +3,7 @@ import asyncio
 from aioquic.quic.configuration import QuicConfiguration
 import echo_client
 import quic_engine
+import replay
 import certs.echo_server as echo_server
 
 def client_mode(args):
@@ -19,9 +20,22 @@ def server_mode(args):
     listen_port = args.port
     cert_file = args.cert_file
     key_file = args.key_file
+    capture_file = args.capture
+    if args.accounts:
+        echo_server.load_credentials(args.accounts)
     
     server_config = quic_engine.build_server_quic_config(cert_file, key_file)
-    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config))
+    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config, capture_file,
+                                       args.monitor, args.profile_seconds, args.profile_dir,
+                                       not args.stock_udp, args.drain_delay, args.drain_window,
+                                       args.drain_grace))
+
+def replay_mode(args):
+    speed = None if args.speed == 'max' else float(args.speed)
+    
+    config = quic_engine.build_client_quic_config(args.cert_file)
+    asyncio.run(replay.run_replay(args.server, args.port, config, args.capture_file,
+                                  speed, args.copies, args.report, args.compare, args.accounts))
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Echo example')
@@ -37,6 +51,26 @@ def parse_args():
     server_parser.add_argument('-k','--key-file', default='./certs/quic_private_key.pem', help='Key file (for self signed certs)')
     server_parser.add_argument('-l','--listen', default='localhost', help='Address to listen on')
     server_parser.add_argument('-p','--port', type=int, default=55667, help='Port to listen on')
+    server_parser.add_argument('--capture', default=None, help='Record all PDUs to this JSON Lines file')
+    server_parser.add_argument('--accounts', default=None, help='JSON file of {"username": "password"} to allow on top of the defaults')
+    server_parser.add_argument('--monitor', action='store_true', help='Track event loop lag and slow callbacks (SIGUSR1 = report, SIGUSR2 = profile)')
+    server_parser.add_argument('--profile-seconds', type=float, default=10, help='How long a SIGUSR2 profile samples for')
+    server_parser.add_argument('--profile-dir', default='.', help='Where SIGUSR2 profiles are written')
+    server_parser.add_argument('--stock-udp', action='store_true', help="Use aioquic's default UDP endpoint instead of the batched one")
+    server_parser.add_argument('--drain-delay', type=int, default=None, help='On SIGTERM, ms clients wait before reconnecting (default: twice --drain-grace, how long the drain can take)')
+    server_parser.add_argument('--drain-window', type=int, default=quic_engine.DRAIN_WINDOW_MS, help='On SIGTERM, ms of random jitter added to each client\'s reconnect delay')
+    server_parser.add_argument('--drain-grace', type=float, default=quic_engine.DRAIN_GRACE, help='On SIGTERM, seconds to wait for pending sends before closing')
+
+    replay_parser = subparsers.add_parser('replay')
+    replay_parser.add_argument('capture_file', help='Capture file recorded with server --capture')
+    replay_parser.add_argument('-s','--server', default='localhost', help='Host to replay against')
+    replay_parser.add_argument('-p','--port', type=int, default=55667, help='Port to replay against')
+    replay_parser.add_argument('-c','--cert-file', default='./certs/quic_certificate.pem', help='Certificate file (for self signed certs)')
+    replay_parser.add_argument('--speed', default='1', help='Timing multiplier (1, 10, ...) or "max" to send as fast as possible')
+    replay_parser.add_argument('--copies', type=int, default=1, help='Number of concurrent copies of each captured connection')
+    replay_parser.add_argument('--report', default=None, help='Write the latency/throughput report to this file')
+    replay_parser.add_argument('--compare', default=None, help='Earlier report to print deltas against')
+    replay_parser.add_argument('--accounts', default=None, help='JSON file of {"username": "password"}, one account per replayed login')
        
     return parser.parse_args()
 
@@ -47,6 +81,8 @@ if __name__ == '__main__':
         client_mode(args)
     elif args.mode == 'server':
         server_mode(args)
+    elif args.mode == 'replay':
+        replay_mode(args)
     else:
         print('Invalid mode')
 
@@ -29,6 +29,15 @@ class ChatClient:
         print(f"[cli] transitioning from {self.state} to {new_state}")
         self.state = new_state
 
+    # the server is going away and told us when to come back, run_client picks this up
+    # from the scope once we return and reconnects after the delay
+    def handle_reconnect(self, reconnect_msg, scope):
+        delay_ms = reconnect_msg.payload.get("delay_ms", 0)
+        window_ms = reconnect_msg.payload.get("window_ms", 0)
+        print(f"[cli] Server is restarting, reconnecting in {delay_ms} ms")
+        scope["reconnect"] = {"delay_ms": delay_ms, "window_ms": window_ms}
+        self.transition_state(ClientState.DISCONNECTED)
+
     # error handling for the errors defined in our PDU
     async def handle_error(self, error_msg):
         error_code = error_msg.payload.get("error_code")
@@ -54,20 +63,32 @@ class ChatClient:
             
         return True
 
+# input() runs in a thread and can't be cancelled, so if we stop waiting on it (like when
+# reconnecting) the next call picks up the same read instead of starting a second one
+_pending_input = None
+
 # this waits for user input from each client
 async def get_user_input(prompt):
-    wait = asyncio.get_event_loop()
-    return await wait.run_in_executor(None, input, prompt)
+    global _pending_input
+    if _pending_input is None:
+        wait = asyncio.get_event_loop()
+        _pending_input = wait.run_in_executor(None, input, prompt)
+    try:
+        return await asyncio.shield(_pending_input)
+    finally:
+        if _pending_input is not None and _pending_input.done():
+            _pending_input = None
 
 # this is a much needed method that helps check whether each connection is healthy or not
 # for example, if you hit ctrl+c while in a client, this lets the server find out that
 # the client is no longer responsive because it hasn't received a ping 
-async def ping_loop(conn, client_id):
+# pings go out as datagrams, stream_id is where they go if the server can't take those
+async def ping_loop(conn, client_id, stream_id):
     try:
         while True:
             await asyncio.sleep(10)
             ping = pdu.ping_message(client_id)
-            await conn.send(QuicStreamEvent(0, ping.to_bytes(), False))
+            await conn.send(ping.to_event(stream_id))
     except asyncio.CancelledError:
         print("[cli] Ping cancelled")
     except Exception as e:
@@ -89,9 +110,11 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
         # supported_versions = ["0"]
         version_request = pdu.version_request(supported_versions)
 
+        # nothing else goes on this stream, so we end it right away and the server can
+        # let go of it once it has answered
         print("[cli] Sending version request")
         new_stream_id = conn.new_stream()
-        await conn.send(QuicStreamEvent(new_stream_id, version_request.to_bytes(), False))
+        await conn.send(version_request.to_event(new_stream_id, True))
 
         # get the VERSION_RESPONSE from the server
         message = await conn.receive()
@@ -106,20 +129,28 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
         elif response.mtype == pdu.ERROR_MESSAGE:
             await client.handle_error(response)
             return
+        elif response.mtype == pdu.RECONNECT_MESSAGE:
+            client.handle_reconnect(response, scope)
+            return
         else:
             print("[cli] Unexpected message type during version negotiation")
             return
 
         # LOGIN_REQUEST
         # allows user to enter user/pass and attempt to login
+        # when we're reconnecting after a server restart we already have them
         client.transition_state(ClientState.CONNECTED)
-        username = await get_user_input("Username: ")
-        password = await get_user_input("Password: ")
+        if "username" in scope and "password" in scope:
+            username = scope["username"]
+            password = scope["password"]
+        else:
+            username = await get_user_input("Username: ")
+            password = await get_user_input("Password: ")
         print("[cli] Sending login request")
         login_message = pdu.login_request(username, password)
         client.transition_state(ClientState.REQUEST)
         new_stream_id = conn.new_stream()
-        qs = QuicStreamEvent(new_stream_id, login_message.to_bytes(), False)
+        qs = login_message.to_event(new_stream_id)
         await conn.send(qs)
 
         # gets the result of the login attempt from the server
@@ -134,6 +165,10 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
         if response.mtype == pdu.ERROR_MESSAGE:
             await client.handle_error(response)
             return
+
+        if response.mtype == pdu.RECONNECT_MESSAGE:
+            client.handle_reconnect(response, scope)
+            return
         
         # if its not a login response, just disconnect user
         if response.mtype != pdu.LOGIN_RESPONSE:
@@ -148,10 +183,12 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
             return
         
         # else they successfully logged in!
+        scope["username"] = username
+        scope["password"] = password
         client.id = response.payload["id"]
         client.transition_state(ClientState.READY)
         print(f"[cli] Login successful, assigned ID: {client.id}")
-        ping_task = asyncio.create_task(ping_loop(conn, client.id))
+        ping_task = asyncio.create_task(ping_loop(conn, client.id, new_stream_id))
 
         # CHAT_MESSAGE
         print("[cli] Entering chat mode")
@@ -159,10 +196,36 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
         client.transition_state(ClientState.CHATTING)
 
         # infinite loop while chatting until we !quit or !exit or disconnect somehow
+        reconnecting = False
+        input_task = None
+        server_task = None
         while True:
             try:
                 # just a cool way to show/prompt the user for input
-                chat_input = await get_user_input('> ')
+                # we also listen to the server while waiting, so we notice it telling us
+                # to reconnect even if the user isn't typing anything
+                if input_task is None:
+                    input_task = asyncio.ensure_future(get_user_input('> '))
+                if server_task is None:
+                    server_task = asyncio.ensure_future(conn.receive())
+                done, _ = await asyncio.wait({input_task, server_task},
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                if server_task in done:
+                    server_msg = pdu.Message.from_bytes(server_task.result().data)
+                    server_task = None
+                    if server_msg.mtype == pdu.RECONNECT_MESSAGE:
+                        client.handle_reconnect(server_msg, scope)
+                        reconnecting = True
+                        break
+                    if server_msg.mtype == pdu.ERROR_MESSAGE:
+                        await client.handle_error(server_msg)
+                        return
+                    print("[cli] server message: ", server_msg.payload)
+                    continue
+
+                chat_input = input_task.result()
+                input_task = None
 
                 # this is how they can logout
                 if chat_input.lower() in ['!quit', '!exit']:
@@ -177,11 +240,17 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
                 current_time = int(time())
                 chat_msg = pdu.chat_message(client.id, current_time, chat_input)
 
-                await conn.send(QuicStreamEvent(new_stream_id, chat_msg.to_bytes(), False))
+                await conn.send(chat_msg.to_event(new_stream_id))
 
-                chat_response: QuicStreamEvent = await conn.receive()
+                chat_response: QuicStreamEvent = await server_task
+                server_task = None
                 chat_response_msg = pdu.Message.from_bytes(chat_response.data)
 
+                if chat_response_msg.mtype == pdu.RECONNECT_MESSAGE:
+                    client.handle_reconnect(chat_response_msg, scope)
+                    reconnecting = True
+                    break
+
                 if chat_response_msg.mtype == pdu.ERROR_MESSAGE:
                     await client.handle_error(chat_response_msg)
                     return
@@ -195,12 +264,21 @@ async def echo_client_proto(scope:Dict, conn:EchoQuicConnection):
                 print(f"[cli] Error while chatting: {e}")
                 break
 
+        if server_task is not None:
+            server_task.cancel()
+
+        # the server is restarting, no logout since it's dropping our session anyway
+        # and we'll log back in once we reconnect
+        if reconnecting:
+            ping_task.cancel()
+            return
+
         # this triggers when we do !exit or !quit, if we hit ctrl+c, then we immediately
         # go to disconnected state
         # LOGOUT_MESSAGE
         print("[cli] sending logout")
         logout = pdu.logout_message(client.id)
-        logout_event = QuicStreamEvent(conn.new_stream(), logout.to_bytes(), False)
+        logout_event = logout.to_event(conn.new_stream(), True)
         ping_task.cancel()
         await conn.send(logout_event)
 
@@ -1,10 +1,14 @@
 from typing import Coroutine,Callable, Optional
 
+# datagram and priority are left as None when the sender didn't decide, in which case
+# they're filled in from the PDU type (see pdu.tag_event)
 class QuicStreamEvent():
-    def __init__(self, stream_id, data, end_stream):
+    def __init__(self, stream_id, data, end_stream, datagram=None, priority=None):
         self.stream_id = stream_id
         self.data = data
         self.end_stream = end_stream
+        self.datagram = datagram
+        self.priority = priority
         
 class EchoQuicConnection():
     def __init__(self, send:Coroutine[QuicStreamEvent, None, None], 
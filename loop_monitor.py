@@ -0,0 +1,200 @@
+import asyncio
+import asyncio.events
+import os
+import signal
+import sys
+import threading
+from collections import Counter, deque
+from time import perf_counter, sleep, time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+# upper bounds (in ms) of the lag histogram buckets, anything bigger lands in the last one
+LAG_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+# how often the lag probe wakes up, and how long a single callback can run before we report it
+PROBE_INTERVAL = 0.1
+SLOW_CALLBACK_THRESHOLD = 0.05
+
+# how many slow callback reports we keep around, oldest get dropped first
+MAX_SLOW_REPORTS = 50
+
+# sampling rate for the profiler and the longest profile we let anyone ask for
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+# gives a readable name for whatever a loop callback is going to run. for tasks this is
+# the coroutine (e.g. echo_server_proto), for plain callbacks it's the function
+def describe_callback(handle) -> str:
+    callback = getattr(handle, "_callback", None)
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        name = getattr(coro, "__qualname__", None) or repr(coro)
+        frame = getattr(coro, "cr_frame", None)
+        if frame is not None:
+            return f"{name} ({frame.f_code.co_filename}:{frame.f_lineno})"
+        return name
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+# keeps track of how late the event loop is running and which callbacks are hogging it.
+# the probe is a task that asks to wake up every PROBE_INTERVAL, how much later than that
+# it actually wakes up is the time the loop spent busy with something else
+class LoopLagMonitor:
+    def __init__(self, slow_threshold: float = SLOW_CALLBACK_THRESHOLD):
+        self.slow_threshold = slow_threshold
+        self.histogram: List[int] = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.max_lag = 0.0
+        self.samples = 0
+        self.slow_callbacks: Deque[Tuple[float, float, str]] = deque(maxlen=MAX_SLOW_REPORTS)
+        self._original_run = None
+        self._probe: Optional[asyncio.Task] = None
+
+    def record_lag(self, lag: float) -> None:
+        lag_ms = lag * 1000
+        for i, bound in enumerate(LAG_BUCKETS_MS):
+            if lag_ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+        self.samples += 1
+        self.max_lag = max(self.max_lag, lag)
+
+    async def probe(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + PROBE_INTERVAL
+            await asyncio.sleep(PROBE_INTERVAL)
+            self.record_lag(max(0.0, loop.time() - expected))
+
+    # wraps Handle._run so every loop callback gets timed. this only costs two clock
+    # reads per callback, unlike asyncio debug mode, so it's fine to leave on
+    def _install_timing(self) -> None:
+        monitor = self
+        original_run = asyncio.events.Handle._run
+        self._original_run = original_run
+
+        def timed_run(handle):
+            started = perf_counter()
+            try:
+                return original_run(handle)
+            finally:
+                took = perf_counter() - started
+                if took >= monitor.slow_threshold:
+                    monitor.slow_callbacks.append((time(), took, describe_callback(handle)))
+
+        asyncio.events.Handle._run = timed_run
+
+    def start(self) -> None:
+        if self._probe is not None:
+            return
+        self._install_timing()
+        self._probe = asyncio.ensure_future(self.probe())
+
+    def stop(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def report(self) -> str:
+        lines = [f"[mon] Event loop lag over {self.samples} samples (max {self.max_lag * 1000:.1f} ms):"]
+        lower = 0
+        for bound, count in zip(LAG_BUCKETS_MS, self.histogram):
+            lines.append(f"[mon]   {lower:>4}-{bound:<4} ms: {count}")
+            lower = bound
+        lines.append(f"[mon]   >{LAG_BUCKETS_MS[-1]:<8} ms: {self.histogram[-1]}")
+        lines.append(f"[mon] Slow callbacks (>= {self.slow_threshold * 1000:.0f} ms), most recent last:")
+        if not self.slow_callbacks:
+            lines.append("[mon]   none")
+        for when, took, name in self.slow_callbacks:
+            lines.append(f"[mon]   {when:.3f} {took * 1000:.1f} ms {name}")
+        return "\n".join(lines)
+
+# turns a frame into a folded stack line (root first, frames separated by ';'), which is
+# what flamegraph.pl, speedscope and friends read
+def fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+# statistical profiler for the thread running the event loop. a helper thread wakes up every
+# PROFILE_INTERVAL and records where the loop thread currently is. nothing runs unless a
+# profile was asked for, and only one profile runs at a time
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self, target_thread: int, seconds: float) -> Counter:
+        stacks: Counter = Counter()
+        deadline = perf_counter() + seconds
+        while perf_counter() < deadline:
+            frame = sys._current_frames().get(target_thread)
+            if frame is not None:
+                stacks[fold_stack(frame)] += 1
+            del frame
+            sleep(self.interval)
+        return stacks
+
+    def _run(self, target_thread: int, seconds: float, out_file: str) -> None:
+        stacks = self.sample(target_thread, seconds)
+        with open(out_file, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"[mon] Wrote {sum(stacks.values())} samples to {out_file}")
+
+    # starts profiling the calling thread in the background, returns False if a profile
+    # is already running
+    def start(self, seconds: float, out_file: str) -> bool:
+        if self.is_running():
+            return False
+        seconds = max(0.0, min(seconds, MAX_PROFILE_SECONDS))
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(threading.get_ident(), seconds, out_file),
+            name="loop-profiler",
+            daemon=True
+        )
+        self._thread.start()
+        return True
+
+# arms the monitor on the running loop. SIGUSR1 prints the lag report and SIGUSR2 samples
+# the loop for profile_seconds and writes the folded stacks to profile_dir.
+# signals aren't available on every platform, in which case only the monitor runs
+def arm(profile_seconds: float = 10, profile_dir: str = ".") -> Tuple[LoopLagMonitor, SamplingProfiler]:
+    monitor = LoopLagMonitor()
+    profiler = SamplingProfiler()
+    monitor.start()
+
+    def dump_report():
+        print(monitor.report())
+
+    def start_profile():
+        out_file = os.path.join(profile_dir, f"profile-{int(time())}.folded")
+        if profiler.start(profile_seconds, out_file):
+            print(f"[mon] Profiling for {profile_seconds}s into {out_file}")
+        else:
+            print("[mon] Profile already running, ignoring")
+
+    loop = asyncio.get_running_loop()
+    handlers: Dict[str, Callable[[], None]] = {"SIGUSR1": dump_report, "SIGUSR2": start_profile}
+    for name, handler in handlers.items():
+        signum = getattr(signal, name, None)
+        if signum is None:
+            continue
+        try:
+            loop.add_signal_handler(signum, handler)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    print(f"[mon] Loop monitor armed (pid {os.getpid()}: SIGUSR1 = lag report, SIGUSR2 = profile)")
+    return monitor, profiler
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import statistics
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+from echo_quic import EchoQuicConnection, QuicStreamEvent
+import certs.echo_server as echo_server
+import pdu
+
+# in-process stand in for a QUIC connection, no UDP and no TLS. the client side gets an
+# EchoQuicConnection just like EchoClientRequestHandler hands out, and every new stream the
+# client writes to starts an echo_server_proto task just like AsyncQuicServer does, so
+# the protocol code can't tell the difference. that includes the lifecycle: the scope is
+# shared by every stream, a stream's task and queue go away once the task is done, and
+# closing wakes every stream up with None
+class LoopbackConnection:
+    def __init__(self, scope: Optional[Dict] = None):
+        self.scope = scope if scope is not None else {"client_id": None}
+        self.client_queue: asyncio.Queue[QuicStreamEvent] = asyncio.Queue()
+        self.server_queues: Dict[int, asyncio.Queue] = {}
+        self.server_tasks: Dict[int, asyncio.Task] = {}
+        self.peak_server_tasks = 0
+        self.next_stream_id = 0
+        self.closed = False
+
+    # client initiated bidirectional stream ids go up by 4, same as in QUIC
+    def new_stream(self) -> int:
+        stream_id = self.next_stream_id
+        self.next_stream_id += 4
+        return stream_id
+
+    def _server_connection(self, stream_id: int) -> EchoQuicConnection:
+        queue = self.server_queues[stream_id]
+
+        async def receive() -> QuicStreamEvent:
+            return await queue.get()
+
+        def close() -> None:
+            self.remove_stream(stream_id)
+            self.close()
+
+        return EchoQuicConnection(self.server_send, receive, close, None)
+
+    # datagrams don't belong to a stream, so like the real server they go to the oldest one
+    async def client_send(self, message: QuicStreamEvent) -> None:
+        if self.closed:
+            raise ConnectionResetError("Loopback connection closed")
+        stream_id = message.stream_id
+        if message.datagram and self.server_queues:
+            stream_id = next(iter(self.server_queues))
+        if stream_id not in self.server_queues:
+            self._start_stream(stream_id)
+        self.server_queues[stream_id].put_nowait(message)
+
+    def _start_stream(self, stream_id: int) -> None:
+        self.server_queues[stream_id] = asyncio.Queue()
+        task = asyncio.ensure_future(
+            echo_server.echo_server_proto(self.scope, self._server_connection(stream_id)))
+        task.add_done_callback(lambda _: self.remove_stream(stream_id))
+        self.server_tasks[stream_id] = task
+        self.peak_server_tasks = max(self.peak_server_tasks, len(self.server_tasks))
+
+    async def client_receive(self) -> QuicStreamEvent:
+        return await self.client_queue.get()
+
+    async def server_send(self, message: QuicStreamEvent) -> None:
+        if not self.closed:
+            self.client_queue.put_nowait(message)
+
+    def remove_stream(self, stream_id: int) -> None:
+        self.server_queues.pop(stream_id, None)
+        self.server_tasks.pop(stream_id, None)
+
+    # tears down the connection and its session, any server tasks still running see None
+    # and exit
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        echo_server.end_session(self.scope)
+        for queue in self.server_queues.values():
+            queue.put_nowait(None)
+
+    # waits for every server task on this connection to finish
+    async def wait_closed(self) -> None:
+        tasks = list(self.server_tasks.values())
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def client_connection(self) -> EchoQuicConnection:
+        return EchoQuicConnection(self.client_send, self.client_receive,
+                                  self.close, self.new_stream)
+
+# scripted version of echo_client_proto: negotiate, login, chat, logout. returns the
+# round trip time of every request that gets a reply
+async def simulated_client(conn: EchoQuicConnection, username: str, password: str,
+                           messages: int) -> List[float]:
+    latencies = []
+
+    async def request(stream_id, message, end_stream=False) -> pdu.Message:
+        sent_at = perf_counter()
+        await conn.send(message.to_event(stream_id, end_stream))
+        reply = await conn.receive()
+        latencies.append(perf_counter() - sent_at)
+        return pdu.Message.from_bytes(reply.data)
+
+    response = await request(conn.new_stream(), pdu.version_request(echo_server.SERVER_SUPPORTED_VERSIONS), True)
+    if response.mtype != pdu.VERSION_RESPONSE:
+        raise RuntimeError(f"version negotiation failed for {username}")
+
+    stream_id = conn.new_stream()
+    response = await request(stream_id, pdu.login_request(username, password))
+    if response.mtype != pdu.LOGIN_RESPONSE or response.payload.get("auth") != 0:
+        raise RuntimeError(f"login failed for {username}")
+    client_id = response.payload["id"]
+
+    for i in range(messages):
+        await request(stream_id, pdu.chat_message(client_id, int(time()), f"message {i}"))
+
+    await conn.send(pdu.logout_message(client_id).to_event(conn.new_stream(), True))
+    return latencies
+
+# runs `clients` simulated clients against the server protocol, all in this loop. each one
+# gets its own throwaway account so they can all be logged in at the same time
+async def run_benchmark(clients: int = 1000, messages: int = 10) -> dict:
+    accounts = {f"bench{i}": f"pass{i}" for i in range(clients)}
+    echo_server.CREDENTIALS.update(accounts)
+    connections = [LoopbackConnection() for _ in range(clients)]
+
+    try:
+        started = perf_counter()
+        results = await asyncio.gather(*(
+            simulated_client(loopback.client_connection(), username, password, messages)
+            for loopback, (username, password) in zip(connections, accounts.items())
+        ), return_exceptions=True)
+        duration = perf_counter() - started
+    finally:
+        for loopback in connections:
+            loopback.close()
+        await asyncio.gather(*(loopback.wait_closed() for loopback in connections))
+        sessions_left = sum(1 for username in accounts if username in echo_server.users)
+        for username in accounts:
+            echo_server.CREDENTIALS.pop(username, None)
+            echo_server.users.discard(username)
+
+    latencies = [latency for result in results if isinstance(result, list) for latency in result]
+    failures = [result for result in results if isinstance(result, Exception)]
+    # requests that got a reply, plus the logout from every client that made it that far
+    pdus = len(latencies) + (clients - len(failures))
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        "clients": clients,
+        "failed_clients": len(failures),
+        # server side tasks should stay bounded per client and all be gone after closing
+        "peak_server_tasks_per_client": max(loopback.peak_server_tasks for loopback in connections),
+        "server_tasks_left": sum(len(loopback.server_tasks) for loopback in connections),
+        "sessions_left": sessions_left,
+        "pdus": pdus,
+        "duration_s": round(duration, 3),
+        "throughput_pdus_s": round(pdus / duration, 2) if duration > 0 else 0.0,
+        "latency_ms": {
+            "p50": round(1000 * quantiles[49], 3),
+            "p90": round(1000 * quantiles[89], 3),
+            "p99": round(1000 * quantiles[98], 3)
+        }
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Protocol layer benchmark over an in-memory loopback')
+    parser.add_argument('--clients', type=int, default=1000, help='Number of simulated clients')
+    parser.add_argument('--messages', type=int, default=10, help='Chat messages each client sends')
+    parser.add_argument('--verbose', action='store_true', help='Keep the server and client output')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    # the protocol code prints on every PDU, hide it unless asked so it doesn't swamp the results
+    with open(os.devnull, 'w') as devnull:
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+        with output:
+            report = asyncio.run(run_benchmark(args.clients, args.messages))
+    print(f"[lpb] {report}")
@@ -1,5 +1,8 @@
 
 import json
+import struct
+from typing import List
+from echo_quic import QuicStreamEvent
 
 # our PDUs
 LOGIN_REQUEST = 1
@@ -10,6 +13,7 @@ ERROR_MESSAGE = 5
 PING_MESSAGE = 6
 VERSION_REQUEST = 7
 VERSION_RESPONSE = 8
+RECONNECT_MESSAGE = 9
 
 # enums
 ERROR_SUDDEN_DISCONNECT = 1
@@ -27,6 +31,99 @@ ERROR_DESCRIPTIONS = {
     ERROR_UNSUPPORTED_VERSION: "Incompatible version"
 }
 
+# delivery channels, either a reliable stream or an unreliable QUIC DATAGRAM frame (RFC 9221)
+DELIVERY_STREAM = 0
+DELIVERY_DATAGRAM = 1
+
+# which channel each PDU type goes over, anything not listed here uses a reliable stream
+# pings go stale as soon as the next one is sent, so losing one is fine and they should
+# never be retransmitted or hold up chat traffic
+DELIVERY_POLICY = {
+    PING_MESSAGE: DELIVERY_DATAGRAM
+}
+
+# looks up the delivery channel for a message type
+def delivery_for(mtype: int):
+    return DELIVERY_POLICY.get(mtype, DELIVERY_STREAM)
+
+# priority classes for outgoing PDUs. control always goes out first, interactive and bulk
+# share what's left of the connection with interactive getting the bigger share
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+# which priority class each PDU type gets, anything not listed is interactive
+PRIORITY_POLICY = {
+    VERSION_REQUEST: PRIORITY_CONTROL,
+    VERSION_RESPONSE: PRIORITY_CONTROL,
+    LOGIN_REQUEST: PRIORITY_CONTROL,
+    LOGIN_RESPONSE: PRIORITY_CONTROL,
+    LOGOUT_MESSAGE: PRIORITY_CONTROL,
+    ERROR_MESSAGE: PRIORITY_CONTROL,
+    PING_MESSAGE: PRIORITY_CONTROL,
+    RECONNECT_MESSAGE: PRIORITY_CONTROL,
+    CHAT_MESSAGE: PRIORITY_INTERACTIVE
+}
+
+# interactive payloads bigger than this (in bytes) are treated as bulk
+BULK_PAYLOAD_SIZE = 4096
+
+# looks up the priority class for a message type and payload size
+def priority_for(mtype: int, size: int = 0):
+    priority = PRIORITY_POLICY.get(mtype, PRIORITY_INTERACTIVE)
+    if priority == PRIORITY_INTERACTIVE and size > BULK_PAYLOAD_SIZE:
+        return PRIORITY_BULK
+    return priority
+
+# fills in the delivery channel and priority class of an outgoing event that wasn't built
+# with Message.to_event, by decoding it. anything that doesn't decode goes reliably
+def tag_event(event):
+    if event.datagram is not None and event.priority is not None:
+        return event
+    try:
+        message = Message.from_bytes(event.data)
+        mtype, size = message.mtype, message.sz
+    except (ValueError, KeyError, TypeError):
+        mtype, size = None, len(event.data)
+    if event.datagram is None:
+        event.datagram = mtype is not None and delivery_for(mtype) == DELIVERY_DATAGRAM
+    if event.priority is None:
+        event.priority = priority_for(mtype, size)
+    return event
+
+# on a stream every PDU goes out as a 4 byte big endian length followed by the JSON. QUIC
+# hands stream data over in whatever pieces it arrived in, so a big PDU can show up split
+# across several reads and small ones can show up glued together. datagrams always carry
+# exactly one PDU, so they aren't framed
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1024 * 1024
+
+def frame(data: bytes) -> bytes:
+    if len(data) > MAX_FRAME_SIZE:
+        raise ValueError(f"PDU of {len(data)} bytes is over the {MAX_FRAME_SIZE} byte limit")
+    return FRAME_HEADER.pack(len(data)) + data
+
+# puts PDUs back together from the stream data of one stream
+class FrameReader:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    # takes the next piece of stream data, returns every PDU it completed. raises ValueError
+    # if the peer announces a PDU over MAX_FRAME_SIZE, the stream can't be trusted after that
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer += data
+        pdus = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (size,) = FRAME_HEADER.unpack_from(self.buffer)
+            if size > MAX_FRAME_SIZE:
+                raise ValueError(f"PDU of {size} bytes is over the {MAX_FRAME_SIZE} byte limit")
+            end = FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            pdus.append(bytes(self.buffer[FRAME_HEADER.size:end]))
+            del self.buffer[:end]
+        return pdus
+
 # actual message object, has message type, the payload which is a python dictionary
 # and the size of the payload.
 class Message:
@@ -60,6 +157,13 @@ class Message:
     def from_bytes(json_bytes):
         return Message.from_json(json_bytes.decode('utf-8'))
 
+    # builds the event for sending this message, with its delivery channel and priority
+    # class looked up from the policies above
+    def to_event(self, stream_id: int, end_stream: bool = False):
+        return QuicStreamEvent(stream_id, self.to_bytes(), end_stream,
+                               delivery_for(self.mtype) == DELIVERY_DATAGRAM,
+                               priority_for(self.mtype, self.sz))
+
 # checks the validity of the login request (less than 32 characters, and not empty)
 def login_request(username: str, password: str):
     if len(username) > 32 or len(password) > 32:
@@ -102,6 +206,11 @@ def version_response(selected_version: str, success: bool):
         "success": success
     })
 
+# server is going away, tells the client to reconnect after delay_ms. if that fails the
+# client backs off with random delays that start out spread over window_ms
+def reconnect_message(id: int, delay_ms: int, window_ms: int):
+    return Message(RECONNECT_MESSAGE, {"id": id, "delay_ms": delay_ms, "window_ms": window_ms})
+
 # this is how we can send back to the client a failed versioning attempt
 def error_unsupported_version():
     return error_message(-1, ERROR_UNSUPPORTED_VERSION, ERROR_DESCRIPTIONS[ERROR_UNSUPPORTED_VERSION])
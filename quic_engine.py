@@ -1,8 +1,16 @@
 import asyncio
-from aioquic.asyncio import connect, serve
+import itertools
+import random
+import signal
+from contextlib import AsyncExitStack
+from functools import partial
+from aioquic.asyncio import connect
 from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.asyncio.server import QuicServer
+from aioquic.buffer import Buffer
+from aioquic.quic.packet import pull_quic_header
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived
+from aioquic.quic.events import StreamDataReceived, DatagramFrameReceived, ConnectionTerminated
 from typing import Optional, Dict, Callable, Coroutine, Deque, List
 from aioquic.tls import SessionTicket
 
@@ -11,16 +19,55 @@ from collections import deque
 import json
 
 from echo_quic import EchoQuicConnection, QuicStreamEvent
+from capture import TrafficCapture, DIRECTION_IN, DIRECTION_OUT
+import loop_monitor
+from udp_batch import create_batched_datagram_endpoint
+from scheduler import OutboundScheduler
 import certs.echo_server as echo_server, echo_client
+import pdu
 
 from certs.echo_server import remove_inactive_clients
 
 ALPN_PROTOCOL = "echo-protocol"
 
+# largest DATAGRAM frame we accept (RFC 9221), advertised to the peer during the handshake
+MAX_DATAGRAM_FRAME_SIZE = 65536
+
+# a DATAGRAM frame can't be split, so it has to fit in one packet along with the packet
+# header (up to a 20 byte connection id), packet number, AEAD tag and the frame's own
+# type and length. this is a bit more than all of that
+DATAGRAM_PACKET_OVERHEAD = 64
+
+# whether a DATAGRAM frame carrying data can be sent on this connection. the peer has to
+# have advertised support, and the frame has to fit in a single packet. aioquic keeps one
+# that doesn't at the head of its queue forever, blocking every datagram behind it
+def datagram_fits(quic, data: bytes) -> bool:
+    max_frame = getattr(quic, "_remote_max_datagram_frame_size", None)
+    if max_frame is None:
+        return False
+    packet_size = getattr(quic, "_max_datagram_size", quic.configuration.max_datagram_size)
+    return len(data) <= min(max_frame, packet_size - DATAGRAM_PACKET_OVERHEAD)
+
+# defaults for draining on SIGTERM: we wait up to DRAIN_GRACE seconds for sends to flush and
+# again for connections to close, and clients are told to come back after a delay plus a
+# random share of DRAIN_WINDOW_MS. new handshakes are dropped for the whole drain, so unless
+# run_server is given one the delay is the two waits together
+DRAIN_WINDOW_MS = 10000
+DRAIN_GRACE = 5.0
+
+# how long a client waits for the handshake before treating the server as not there. a
+# draining server drops our Initial packets, and without this we'd wait for the idle timeout
+HANDSHAKE_TIMEOUT = 5.0
+
+# if the server isn't back when a client reconnects, the client retries after a random delay
+# from an exponentially growing range (starting at the window the server gave), capped here
+RECONNECT_MAX_BACKOFF_MS = 60000
+
 def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
     configuration = QuicConfiguration(
         alpn_protocols=[ALPN_PROTOCOL], 
-        is_client=False
+        is_client=False,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE
     )
     configuration.load_cert_chain(cert_file, key_file)
   
@@ -28,7 +75,8 @@ def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
 
 def build_client_quic_config(cert_file = None):
     configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL], 
-                                      is_client=True)
+                                      is_client=True,
+                                      max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE)
     if cert_file:
         configuration.load_verify_locations(cert_file)
   
@@ -40,12 +88,22 @@ def create_msg_payload(msg):
 SERVER_MODE = 0
 CLIENT_MODE = 1
 
+# hands out an id per connection so captured traffic can be grouped by connection
+_connection_ids = itertools.count(1)
+
 class AsyncQuicServer(QuicConnectionProtocol):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, capture: Optional[TrafficCapture] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self._conn_id: int = next(_connection_ids)
+        self._capture: Optional[TrafficCapture] = capture
         self._handlers: Dict[int, EchoServerRequestHandler] = {}
-        self._client_handler: Optional[EchoClientRequestHandler] = None
         self._is_client: bool = self._quic.configuration.is_client
+        # only the server moves bulk to a stream of its own, see OutboundScheduler
+        self._scheduler = OutboundScheduler(self._quic, remap_bulk=not self._is_client,
+                                            on_write=self._captured_write)
+        # session state for the whole connection, shared by the handler of every stream
+        self._scope: Dict = {"client_id": None}
+        self._client_handler: Optional[EchoClientRequestHandler] = None
         self._mode: int = SERVER_MODE if not self._is_client else CLIENT_MODE
         if self._mode == CLIENT_MODE:
             self._attach_client_handler()
@@ -62,32 +120,85 @@ class AsyncQuicServer(QuicConnectionProtocol):
                         transmit=self.transmit
                  )
         
+    # writes a PDU to the traffic capture, if one is enabled
+    def capture(self, stream_id, direction, data, datagram=False, reply_to=None):
+        if self._capture is not None:
+            self._capture.record(self._conn_id, stream_id, direction, data, datagram, reply_to)
+
+    # outgoing stream PDUs are captured once the scheduler has picked the stream they go on
+    def _captured_write(self, stream_id: int, message: QuicStreamEvent) -> None:
+        self.capture(stream_id, DIRECTION_OUT, message.data, reply_to=message.stream_id)
+
+    # queues an outgoing PDU by priority class, it's written out on the next transmit
+    def schedule(self, message: QuicStreamEvent, priority: int) -> None:
+        self._scheduler.enqueue(message, priority)
+
+    def transmit(self) -> None:
+        self._scheduler.pump()
+        super().transmit()
+
+    # server is shutting down, tell the client when to come back. goes out on the oldest
+    # stream since the client reads every stream the same way. if the client has closed
+    # all of its streams it goes out on a new one of ours instead
+    async def drain(self, delay_ms: int, window_ms: int) -> None:
+        if self._handlers:
+            handler = next(iter(self._handlers.values()))
+        else:
+            handler = self._new_handler(self._quic.get_next_available_stream_id())
+        await echo_server.send_reconnect(handler.echo_connection(), handler.stream_id,
+                                         self._scope, delay_ms, window_ms)
+
+    def has_pending_output(self) -> bool:
+        return self._scheduler.unflushed()
+
     def remove_handler(self, stream_id):
-        self._handlers.pop(stream_id)
+        self._handlers.pop(stream_id, None)
+
+    # once a stream's echo_server_proto task is done, its handler and queue go with it
+    def _handler_finished(self, handler, task):
+        if self._handlers.get(handler.stream_id) is handler:
+            self.remove_handler(handler.stream_id)
         
     def _quic_client_event_dispatch(self, event):
         if isinstance(event, StreamDataReceived):
             self._client_handler.quic_event_received(event)
+        elif isinstance(event, DatagramFrameReceived):
+            self._client_handler.datagram_received(event)
         
+    def _new_handler(self, stream_id: int):
+        return EchoServerRequestHandler(
+                authority=self._quic.configuration.server_name,
+                connection=self._quic,
+                protocol=self,
+                scope=self._scope,
+                stream_ended=False,
+                stream_id=stream_id,
+                transmit=self.transmit
+        )
+
     def _quic_server_event_dispatch(self, event):
         handler = None
         if isinstance(event, StreamDataReceived):
             if event.stream_id not in self._handlers:
-                 handler = EchoServerRequestHandler(
-                        authority=self._quic.configuration.server_name,
-                        connection=self._quic,
-                        protocol=self,
-                        scope={},
-                        stream_ended=False,
-                        stream_id=event.stream_id,
-                        transmit=self.transmit
-                 )
+                 handler = self._new_handler(event.stream_id)
                  self._handlers[event.stream_id] = handler
                  handler.quic_event_received(event)
-                 asyncio.ensure_future(handler.launch_echo())
+                 handler.task = asyncio.ensure_future(handler.launch_echo())
+                 handler.task.add_done_callback(partial(self._handler_finished, handler))
             else:
                 handler = self._handlers[event.stream_id]
                 handler.quic_event_received(event)
+        # datagrams aren't tied to a stream, so they're handled for the whole connection,
+        # whether or not the client has any streams open
+        elif isinstance(event, DatagramFrameReceived):
+            self.capture(None, DIRECTION_IN, event.data, True)
+            echo_server.handle_datagram(self._scope, event.data)
+        # the connection is gone. its session goes with it even if the client had already
+        # closed every stream, then every stream that's left is woken up so it can exit
+        elif isinstance(event, ConnectionTerminated):
+            echo_server.end_session(self._scope)
+            for handler in list(self._handlers.values()):
+                handler.connection_terminated()
 
     def quic_event_received(self, event):
         if self._mode == SERVER_MODE:
@@ -118,25 +229,154 @@ async def monitor_inactivity():
         await remove_inactive_clients()
         await asyncio.sleep(5)
 
-async def run_server(server, server_port, configuration):  
-    print("[svr] Server starting...")  
-    await asyncio.gather(
-        serve(
-            server,
-            server_port,
+# QuicServer that can stop taking new connections. while draining, packets for connections
+# we don't already have are dropped, everything else is handled as usual
+class DrainableQuicServer(QuicServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.draining = False
+
+    def datagram_received(self, data, addr):
+        if self.draining:
+            try:
+                header = pull_quic_header(Buffer(data=data),
+                                          host_cid_length=self._configuration.connection_id_length)
+            except ValueError:
+                return
+            if header.destination_cid not in self._protocols:
+                return
+        super().datagram_received(data, addr)
+
+    def connections(self):
+        return set(self._protocols.values())
+
+# same as aioquic's serve(), but with a DrainableQuicServer, and by default on top of a
+# BatchedDatagramTransport so packets are sent and received in batches
+# (recvmmsg/sendmmsg, GSO/GRO where the platform has them)
+async def serve_drainable(host, port, *, configuration, create_protocol=QuicConnectionProtocol,
+                          session_ticket_fetcher=None, session_ticket_handler=None,
+                          retry=False, stream_handler=None, batched=True) -> DrainableQuicServer:
+    def create_server():
+        return DrainableQuicServer(
             configuration=configuration,
-            create_protocol=AsyncQuicServer,
-            session_ticket_fetcher=SessionTicketStore().pop,
-            session_ticket_handler=SessionTicketStore().add
-        ),
-        monitor_inactivity()
+            create_protocol=create_protocol,
+            session_ticket_fetcher=session_ticket_fetcher,
+            session_ticket_handler=session_ticket_handler,
+            retry=retry,
+            stream_handler=stream_handler
+        )
+
+    if not batched:
+        loop = asyncio.get_event_loop()
+        _, protocol = await loop.create_datagram_endpoint(create_server, local_addr=(host, port))
+        return protocol
+
+    transport, protocol = await create_batched_datagram_endpoint(create_server, local_addr=(host, port))
+    print(f"[svr] Batched UDP: mmsg={transport.mmsg} gso={transport.gso} gro={transport.gro}")
+    return protocol
+
+# graceful shutdown: stop taking new connections, tell every client when to reconnect,
+# give the sends up to `grace` seconds to be flushed and acknowledged, then close
+async def drain_server(quic_server: DrainableQuicServer, delay_ms, window_ms, grace):
+    print("[svr] Draining, no longer accepting new connections")
+    quic_server.draining = True
+    connections = quic_server.connections()
+    await asyncio.gather(*(conn.drain(delay_ms, window_ms) for conn in connections),
+                         return_exceptions=True)
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + grace
+    while loop.time() < deadline and any(conn.has_pending_output() for conn in connections):
+        await asyncio.sleep(0.05)
+
+    for conn in connections:
+        conn.close()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(conn.wait_closed() for conn in connections)),
+                               timeout=grace)
+    except asyncio.TimeoutError:
+        pass
+    quic_server.close()
+    print(f"[svr] Drained {len(connections)} connection(s)")
+
+async def run_server(server, server_port, configuration, capture_file=None,
+                     monitor=False, profile_seconds=10, profile_dir=".", batched_udp=True,
+                     drain_delay_ms=None, drain_window_ms=DRAIN_WINDOW_MS,
+                     drain_grace=DRAIN_GRACE):  
+    print("[svr] Server starting...")  
+    # by default clients stay away for as long as the drain can take
+    if drain_delay_ms is None:
+        drain_delay_ms = int(2 * drain_grace * 1000)
+    lag_monitor = None
+    if monitor:
+        lag_monitor, _ = loop_monitor.arm(profile_seconds, profile_dir)
+    capture = None
+    if capture_file:
+        capture = TrafficCapture(capture_file)
+        print(f"[svr] Capturing traffic to {capture_file}")
+    quic_server = await serve_drainable(
+        server,
+        server_port,
+        configuration=configuration,
+        create_protocol=partial(AsyncQuicServer, capture=capture),
+        session_ticket_fetcher=SessionTicketStore().pop,
+        session_ticket_handler=SessionTicketStore().add,
+        batched=batched_udp
     )
+    inactivity = asyncio.ensure_future(monitor_inactivity())
+
+    # SIGTERM starts a drain instead of killing everything at once
+    stop = asyncio.Event()
+    try:
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except (NotImplementedError, AttributeError, RuntimeError):
+        pass
+    # the capture is written in batches, so whatever is still queued is written out even
+    # if we're stopped some other way (like ctrl+c)
+    try:
+        await stop.wait()
+        await drain_server(quic_server, drain_delay_ms, drain_window_ms, drain_grace)
+    finally:
+        inactivity.cancel()
+        if capture is not None:
+            capture.close()
+        # puts the loop's callbacks back the way they were
+        if lag_monitor is not None:
+            lag_monitor.stop()
   
               
+# the scope outlives a single connection, so a client told to reconnect (see
+# echo_client.handle_reconnect) keeps its login and comes back after the delay it was given
 async def run_client(server, server_port, configuration):    
-    async with connect(server, server_port, configuration=configuration, 
-            create_protocol=AsyncQuicServer) as client:
-        await asyncio.ensure_future(client._client_handler.launch_echo())
+    scope = {}
+    hint = None
+    attempt = 0
+    delay_ms = 0
+    while True:
+        if hint is not None:
+            await asyncio.sleep(delay_ms / 1000)
+        try:
+            async with AsyncExitStack() as stack:
+                client = await asyncio.wait_for(
+                    stack.enter_async_context(connect(server, server_port, configuration=configuration, 
+                                                      create_protocol=AsyncQuicServer)),
+                    timeout=HANDSHAKE_TIMEOUT)
+                client._client_handler.scope = scope
+                await asyncio.ensure_future(client._client_handler.launch_echo())
+        except (OSError, asyncio.TimeoutError) as e:
+            if hint is None:
+                raise
+            attempt += 1
+            backoff = min(RECONNECT_MAX_BACKOFF_MS, max(hint["window_ms"], 1000) * 2 ** attempt)
+            delay_ms = random.uniform(0, backoff)
+            print(f"[cli] Reconnect failed ({e}), retrying in {delay_ms:.0f} ms")
+            continue
+
+        hint = scope.pop("reconnect", None)
+        if hint is None:
+            return
+        attempt = 0
+        delay_ms = hint["delay_ms"]
 
         
 class EchoServerRequestHandler:
@@ -158,35 +398,77 @@ class EchoServerRequestHandler:
         self.scope = scope
         self.stream_id = stream_id
         self.transmit = transmit
+        self.task: Optional[asyncio.Task] = None
+        # stream data comes in pieces, one reader per stream puts the PDUs back together
+        self.frames: Dict[int, pdu.FrameReader] = {}
 
         if stream_ended:
             self.queue.put_nowait({"type": "quic.stream_end"})
         
+    # queues every complete PDU in the stream data, the last one carries end_stream. a stream
+    # that ends between PDUs gets an empty event with end_stream so the protocol still sees it
     def quic_event_received(self, event: StreamDataReceived) -> None:
+        reader = self.frames.setdefault(event.stream_id, pdu.FrameReader())
+        end_stream = event.end_stream
+        try:
+            pdus = reader.feed(event.data)
+        except ValueError as e:
+            side = "cli" if self.protocol.is_client() else "svr"
+            print(f"[{side}] Stopping stream {event.stream_id}: {e}")
+            self.connection.stop_stream(event.stream_id, 0)
+            pdus, end_stream = [], True
+        if end_stream:
+            self.frames.pop(event.stream_id, None)
+
+        for i, data in enumerate(pdus):
+            self.protocol.capture(event.stream_id, DIRECTION_IN, data)
+            self.queue.put_nowait(
+                QuicStreamEvent(event.stream_id, data,
+                                end_stream and i == len(pdus) - 1)
+            )
+        if end_stream and not pdus:
+            self.queue.put_nowait(QuicStreamEvent(event.stream_id, b"", True))
+
+    def datagram_received(self, event: DatagramFrameReceived) -> None:
+        self.protocol.capture(self.stream_id, DIRECTION_IN, event.data, True)
         self.queue.put_nowait(
-            QuicStreamEvent(event.stream_id, event.data, 
-                            event.end_stream)
+            QuicStreamEvent(self.stream_id, event.data, False, True)
         )
+
+    # echo_server_proto treats None as the connection being closed
+    def connection_terminated(self) -> None:
+        self.queue.put_nowait(None)
+
     async def receive(self) -> QuicStreamEvent:
         queue_item = await self.queue.get()
         return queue_item
+
+    def can_send_datagram(self, data: bytes) -> bool:
+        return datagram_fits(self.connection, data)
     
     async def send(self, message: QuicStreamEvent) -> None:
-        self.connection.send_stream_data(
-                stream_id=message.stream_id,
-                data=message.data,
-                end_stream=message.end_stream
-        )
-        
+        # ephemeral PDUs go out as unreliable datagrams when the peer supports it,
+        # otherwise fall back to the reliable stream
+        pdu.tag_event(message)
+        if message.datagram and self.can_send_datagram(message.data):
+            self.protocol.capture(message.stream_id, DIRECTION_OUT, message.data, True)
+            self.connection.send_datagram_frame(message.data)
+            self.transmit()
+            return
+
+        self.protocol.schedule(message, message.priority)
         self.transmit()
         
     def close(self) -> None:
         self.protocol.remove_handler(self.stream_id)
         self.connection.close()
         
-    async def launch_echo(self):
-        qc = EchoQuicConnection(self.send, 
+    def echo_connection(self) -> EchoQuicConnection:
+        return EchoQuicConnection(self.send, 
                 self.receive, self.close, None)
+
+    async def launch_echo(self):
+        qc = self.echo_connection()
         await echo_server.echo_server_proto(self.scope, 
             qc)
         
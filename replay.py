@@ -0,0 +1,285 @@
+import asyncio
+import json
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from aioquic.asyncio import connect
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import stream_is_client_initiated
+from aioquic.quic.events import StreamDataReceived
+
+import pdu
+from quic_engine import datagram_fits
+from capture import load_capture, DIRECTION_IN, DIRECTION_OUT
+
+# how long to wait for the server to answer a replayed PDU before counting it as lost
+REPLY_TIMEOUT = 5.0
+
+# client side protocol for replaying, just collects whatever the server sends back per stream.
+# the server sends bulk payloads on a stream of its own, those go to `waiting_on`, the stream
+# of the PDU we're waiting on replies for (a replay only has one PDU in flight at a time)
+class ReplayProtocol(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replies: Dict[int, asyncio.Queue] = {}
+        self.frames: Dict[int, pdu.FrameReader] = {}
+        self.waiting_on: Optional[int] = None
+
+    def reply_queue(self, stream_id: int) -> asyncio.Queue:
+        if stream_id not in self.replies:
+            self.replies[stream_id] = asyncio.Queue()
+        return self.replies[stream_id]
+
+    def quic_event_received(self, event):
+        if isinstance(event, StreamDataReceived):
+            reader = self.frames.setdefault(event.stream_id, pdu.FrameReader())
+            stream_id = event.stream_id
+            if not stream_is_client_initiated(stream_id) and self.waiting_on is not None:
+                stream_id = self.waiting_on
+            for data in reader.feed(event.data):
+                self.reply_queue(stream_id).put_nowait(data)
+
+# captured PDUs are their JSON object, older captures have them as text
+def parsed_pdu(captured):
+    if isinstance(captured, str):
+        try:
+            return json.loads(captured)
+        except ValueError:
+            return captured
+    return captured
+
+def mtype_of(captured):
+    return captured.get("mtype") if isinstance(captured, dict) else None
+
+# the payload of a captured PDU, or {} if it doesn't have one we can read
+def payload_of(captured) -> dict:
+    payload = captured.get("payload") if isinstance(captured, dict) else None
+    return payload if isinstance(payload, dict) else {}
+
+# turns one captured connection into the list of PDUs the client sent, each tagged with
+# how many replies the server gave to that stream before the client sent anything else
+def build_script(records: List[dict]) -> List[dict]:
+    script = []
+    for record in records:
+        if record["d"] == DIRECTION_IN:
+            script.append({
+                "t": record["t"],
+                "stream": record["s"],
+                "datagram": record.get("g", False),
+                "pdu": parsed_pdu(record["p"]),
+                "expect": 0,
+                "recorded_replies": []
+            })
+        elif record["d"] == DIRECTION_OUT and script and record.get("r", record["s"]) == script[-1]["stream"]:
+            script[-1]["expect"] += 1
+            script[-1]["recorded_replies"].append(parsed_pdu(record["p"]))
+    return script
+
+# client ids are handed out by the server, so the ones in the capture won't match the ones
+# the server gives us this time. we learn the mapping from LOGIN_RESPONSEs and swap them in.
+# returns False if a login that worked in the capture didn't work this time, in which case
+# the ids we'd send from here on belong to nobody (or worse, to another connection)
+def learn_ids(id_map: Dict[int, int], recorded_replies: list, replies: List[bytes]) -> bool:
+    for recorded, actual in zip(recorded_replies, replies):
+        if mtype_of(recorded) != pdu.LOGIN_RESPONSE or payload_of(recorded).get("auth") != 0:
+            continue
+        try:
+            actual_msg = pdu.Message.from_bytes(actual)
+        except (ValueError, KeyError, TypeError):
+            return False
+        actual_payload = actual_msg.payload if isinstance(actual_msg.payload, dict) else {}
+        if actual_msg.mtype != pdu.LOGIN_RESPONSE or actual_payload.get("auth") != 0:
+            return False
+        id_map[payload_of(recorded).get("id")] = actual_payload.get("id")
+    return True
+
+def has_login(script: List[dict]) -> bool:
+    return any(is_login(step["pdu"]) for step in script)
+
+def is_login(captured) -> bool:
+    return mtype_of(captured) == pdu.LOGIN_REQUEST
+
+# the capture only has redacted passwords, and every copy of a connection logging in as the
+# same user would just get ERROR_LOGIN_FROM_OTHER_LOCATION. so each copy gets its own account
+# and every LOGIN_REQUEST in its script is rewritten to use it
+def with_account(script: List[dict], username: str, password: str) -> List[dict]:
+    rewritten = []
+    for step in script:
+        if is_login(step["pdu"]):
+            step = dict(step, pdu=json.loads(pdu.login_request(username, password).to_json()))
+        rewritten.append(step)
+    return rewritten
+
+def load_accounts(path) -> List[Tuple[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return list(json.load(f).items())
+
+# the bytes to send for a captured PDU, with its client id swapped for the one the server
+# gave us this time. anything that isn't a PDU with a payload goes out as it was captured
+def rewrite_ids(captured, id_map: Dict[int, int]) -> bytes:
+    if isinstance(captured, str):
+        return captured.encode("utf-8")
+    payload = payload_of(captured)
+    client_id = payload.get("id")
+    if isinstance(client_id, int) and client_id in id_map:
+        captured = dict(captured, payload=dict(payload, id=id_map[client_id]))
+    return json.dumps(captured).encode("utf-8")
+
+# replays a single captured connection. PDUs are sent in order, waiting for the replies the
+# server gave in the capture before moving on, so the run is deterministic regardless of speed.
+# speed is a multiplier on the captured timing, or None to go as fast as possible
+async def replay_connection(server, server_port, configuration: QuicConfiguration,
+                            script: List[dict], origin: float, speed: Optional[float],
+                            stats: dict):
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    if speed is not None and script:
+        await asyncio.sleep(max(0.0, (script[0]["t"] - origin) / speed))
+
+    try:
+        async with connect(server, server_port, configuration=configuration,
+                           create_protocol=ReplayProtocol) as client:
+            quic = client._quic
+            stream_map: Dict[int, int] = {}
+            id_map: Dict[int, int] = {}
+
+            for step in script:
+                if speed is not None:
+                    due = start + (step["t"] - origin) / speed
+                    delay = due - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                if step["stream"] not in stream_map:
+                    stream_map[step["stream"]] = quic.get_next_available_stream_id()
+                stream_id = stream_map[step["stream"]]
+                data = rewrite_ids(step["pdu"], id_map)
+
+                client.waiting_on = stream_id
+                sent_at = perf_counter()
+                if step["datagram"] and datagram_fits(quic, data):
+                    quic.send_datagram_frame(data)
+                else:
+                    quic.send_stream_data(stream_id, pdu.frame(data), False)
+                client.transmit()
+                stats["sent"] += 1
+
+                replies = []
+                answered = False
+                try:
+                    for _ in range(step["expect"]):
+                        reply = await asyncio.wait_for(client.reply_queue(stream_id).get(),
+                                                       timeout=REPLY_TIMEOUT)
+                        # error replies are counted on their own, they'd make a broken run
+                        # look fast otherwise
+                        if is_error(reply):
+                            stats["error_replies"] += 1
+                        else:
+                            if not answered:
+                                stats["latencies"].append(perf_counter() - sent_at)
+                                answered = True
+                            stats["replies"] += 1
+                        replies.append(reply)
+                except asyncio.TimeoutError:
+                    stats["timeouts"] += 1
+                if not learn_ids(id_map, step["recorded_replies"], replies):
+                    print("[rpl] Login failed, stopping this connection")
+                    stats["failed_logins"] += 1
+                    break
+
+            client.close()
+    except Exception as e:
+        print(f"[rpl] Connection error: {e}")
+        stats["errors"] += 1
+
+def is_error(data: bytes) -> bool:
+    try:
+        return pdu.Message.from_bytes(data).mtype == pdu.ERROR_MESSAGE
+    except (ValueError, KeyError, TypeError):
+        return False
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(stats: dict, duration: float, connections: int) -> dict:
+    latencies = stats["latencies"]
+    return {
+        "connections": connections,
+        "sent": stats["sent"],
+        "replies": stats["replies"],
+        "error_replies": stats["error_replies"],
+        "failed_logins": stats["failed_logins"],
+        "timeouts": stats["timeouts"],
+        "errors": stats["errors"],
+        "duration_s": round(duration, 3),
+        "throughput_pdus_s": round(stats["sent"] / duration, 2) if duration > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(1000 * sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            "p50": round(1000 * percentile(latencies, 50), 3),
+            "p90": round(1000 * percentile(latencies, 90), 3),
+            "p99": round(1000 * percentile(latencies, 99), 3),
+            "max": round(1000 * max(latencies), 3) if latencies else 0.0
+        }
+    }
+
+# prints how this run compares to an earlier report
+def print_deltas(report: dict, baseline: dict):
+    print("[rpl] Compared to baseline:")
+    rows = [("throughput_pdus_s", report["throughput_pdus_s"], baseline.get("throughput_pdus_s", 0.0))]
+    for key, value in report["latency_ms"].items():
+        rows.append((f"latency_ms.{key}", value, baseline.get("latency_ms", {}).get(key, 0.0)))
+    for name, now, before in rows:
+        change = f"{100 * (now - before) / before:+.1f}%" if before else "n/a"
+        print(f"[rpl]   {name}: {before} -> {now} ({change})")
+
+# replays a whole capture file. every captured connection is replayed `copies` times
+# side by side, so a small capture can still drive a lot of concurrent connections.
+# connections that login need an account each from accounts_file, the server has to
+# know the same accounts (server --accounts)
+async def run_replay(server, server_port, configuration: QuicConfiguration, capture_file,
+                     speed: Optional[float] = 1.0, copies: int = 1,
+                     report_file=None, compare_file=None, accounts_file=None) -> dict:
+    scripts = [build_script(records) for records in load_capture(capture_file).values()]
+    scripts = [script for script in scripts if script]
+    if not scripts:
+        print("[rpl] Nothing to replay")
+        return {}
+    origin = min(script[0]["t"] for script in scripts)
+
+    runs = [script for script in scripts for _ in range(copies)]
+    logins = sum(1 for script in runs if has_login(script))
+    if logins:
+        accounts = load_accounts(accounts_file) if accounts_file else []
+        if len(accounts) < logins:
+            print(f"[rpl] {logins} replayed connection(s) login but only {len(accounts)} "
+                  f"account(s) were given, pass more with --accounts")
+            return {}
+        accounts = iter(accounts)
+        runs = [with_account(script, *next(accounts)) if has_login(script) else script
+                for script in runs]
+
+    stats = {"sent": 0, "replies": 0, "error_replies": 0, "failed_logins": 0,
+             "timeouts": 0, "errors": 0, "latencies": []}
+    print(f"[rpl] Replaying {len(scripts)} connection(s) x{copies} at "
+          f"{'max' if speed is None else f'{speed}x'} speed")
+
+    started = perf_counter()
+    await asyncio.gather(*(
+        replay_connection(server, server_port, configuration, script, origin, speed, stats)
+        for script in runs
+    ))
+    report = summarize(stats, perf_counter() - started, len(runs))
+    print(f"[rpl] {json.dumps(report, indent=2)}")
+
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if compare_file:
+        with open(compare_file, "r", encoding="utf-8") as f:
+            print_deltas(report, json.load(f))
+    return report
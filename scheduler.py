@@ -0,0 +1,123 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+from aioquic.quic.connection import stream_is_client_initiated, stream_is_unidirectional
+
+from echo_quic import QuicStreamEvent
+import pdu
+
+# share of the connection interactive and bulk traffic get when both are waiting.
+# control isn't in here, it always goes first
+DEFAULT_WEIGHTS = {
+    pdu.PRIORITY_INTERACTIVE: 4,
+    pdu.PRIORITY_BULK: 1
+}
+
+# bytes of credit a class earns per round for each unit of weight
+QUANTUM = 1200
+
+# how much we hand to aioquic per transmit when we can't see the congestion window,
+# and the least we hand over so a full window never stalls us completely
+FALLBACK_BUDGET = 64 * 1024
+MIN_BUDGET = 1200
+
+# per connection outbound queue. aioquic takes whatever we give it and sends it in the
+# order it was written, so instead of writing straight away, PDUs wait here in one queue
+# per priority class and only about a congestion window's worth is handed over per transmit.
+# control PDUs skip the line, interactive and bulk split the rest with deficit round robin.
+# on the server bulk also gets its own stream so a big payload never sits in front of a
+# reply on the client's stream. control and interactive replies stay on the stream of the
+# request they answer, since that's how clients pair them up. control is written first, so
+# on a shared stream it only ever waits behind the one budget already handed to aioquic.
+# the client doesn't move bulk, the server would answer on
+# whatever stream the bulk PDU came in on and can't send on the client's unidirectional ones.
+# on_write, if given, is called with the stream each PDU actually went out on
+class OutboundScheduler:
+    def __init__(self, quic, weights: Optional[Dict[int, int]] = None, remap_bulk: bool = True,
+                 on_write: Optional[Callable[[int, QuicStreamEvent], None]] = None):
+        self.quic = quic
+        self.remap_bulk = remap_bulk
+        self.on_write = on_write
+        self.weights = weights if weights is not None else dict(DEFAULT_WEIGHTS)
+        self.queues: Dict[int, Deque[QuicStreamEvent]] = {
+            pdu.PRIORITY_CONTROL: deque(),
+            pdu.PRIORITY_INTERACTIVE: deque(),
+            pdu.PRIORITY_BULK: deque()
+        }
+        self.deficits: Dict[int, int] = {priority: 0 for priority in self.weights}
+        self.bulk_stream_id: Optional[int] = None
+        self.reply_stream_id: Optional[int] = None
+
+    def enqueue(self, message: QuicStreamEvent, priority: int) -> None:
+        self.queues[priority].append(message)
+
+    def pending(self) -> bool:
+        return any(self.queues.values())
+
+    # congestion window and bytes in flight. these live on aioquic's private recovery
+    # object, so either can come back as None if they aren't where we expect
+    def _congestion(self):
+        recovery = getattr(self.quic, "_loss", None)
+        cc = getattr(recovery, "_cc", recovery)
+        return getattr(cc, "congestion_window", None), getattr(cc, "bytes_in_flight", None)
+
+    # room left in the congestion window, or a fixed budget if we can't tell
+    def send_budget(self) -> int:
+        window, in_flight = self._congestion()
+        if window is None or in_flight is None:
+            return FALLBACK_BUDGET
+        return max(window - in_flight, MIN_BUDGET)
+
+    # True while anything is still queued here or sent but not yet acknowledged
+    def unflushed(self) -> bool:
+        _, in_flight = self._congestion()
+        return self.pending() or bool(in_flight)
+
+    # False for the peer's unidirectional streams, those only go one way
+    def _can_send_on(self, stream_id: int) -> bool:
+        ours = stream_is_client_initiated(stream_id) == self.quic.configuration.is_client
+        return ours or not stream_is_unidirectional(stream_id)
+
+    def _stream_for(self, message: QuicStreamEvent, priority: int) -> int:
+        if priority == pdu.PRIORITY_BULK and self.remap_bulk:
+            if self.bulk_stream_id is None:
+                self.bulk_stream_id = self.quic.get_next_available_stream_id(is_unidirectional=True)
+            return self.bulk_stream_id
+        if self._can_send_on(message.stream_id):
+            return message.stream_id
+        # answers to something that came in on one of the peer's unidirectional streams go
+        # out on one of ours instead
+        if self.reply_stream_id is None:
+            self.reply_stream_id = self.quic.get_next_available_stream_id(is_unidirectional=True)
+        return self.reply_stream_id
+
+    def _write(self, message: QuicStreamEvent, priority: int) -> None:
+        stream_id = self._stream_for(message, priority)
+        # the bulk and reply streams are shared, so one PDU ending doesn't end the stream
+        end_stream = message.end_stream and stream_id == message.stream_id
+        data = pdu.frame(message.data) if message.data else b""
+        self.quic.send_stream_data(stream_id=stream_id, data=data, end_stream=end_stream)
+        if self.on_write is not None:
+            self.on_write(stream_id, message)
+
+    # hands queued PDUs to aioquic, called right before every transmit
+    def pump(self) -> None:
+        control = self.queues[pdu.PRIORITY_CONTROL]
+        while control:
+            self._write(control.popleft(), pdu.PRIORITY_CONTROL)
+
+        budget = self.send_budget()
+        while budget > 0 and any(self.queues[priority] for priority in self.weights):
+            for priority, weight in self.weights.items():
+                queue = self.queues[priority]
+                if not queue:
+                    self.deficits[priority] = 0
+                    continue
+                self.deficits[priority] += weight * QUANTUM
+                while queue and len(queue[0].data) <= self.deficits[priority] and budget > 0:
+                    message = queue.popleft()
+                    self.deficits[priority] -= len(message.data)
+                    budget -= len(message.data)
+                    self._write(message, priority)
+                if not queue:
+                    self.deficits[priority] = 0
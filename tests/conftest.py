@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import datetime
+import os
+import sys
+from typing import Dict
+
+import pytest
+from aioquic.asyncio import connect
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.quic.events import StreamDataReceived
+
+# the modules live at the top of the repo, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pdu
+import quic_engine
+
+# throwaway self signed certificate for localhost, so tests don't depend on the one in certs/
+@pytest.fixture(scope="session")
+def cert_files(tmp_path_factory):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+            .sign(key, hashes.SHA256()))
+
+    directory = tmp_path_factory.mktemp("certs")
+    cert_file = directory / "cert.pem"
+    key_file = directory / "key.pem"
+    cert_file.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_file.write_bytes(key.private_bytes(serialization.Encoding.PEM,
+                                           serialization.PrivateFormat.PKCS8,
+                                           serialization.NoEncryption()))
+    return str(cert_file), str(key_file)
+
+# the server keeps its sessions in module globals, start every test with a clean slate
+@pytest.fixture(autouse=True)
+def server_state():
+    import certs.echo_server as echo_server
+    credentials = dict(echo_server.CREDENTIALS)
+    echo_server.clients.clear()
+    echo_server.users.clear()
+    yield echo_server
+    echo_server.clients.clear()
+    echo_server.users.clear()
+    echo_server.CREDENTIALS.clear()
+    echo_server.CREDENTIALS.update(credentials)
+
+REPLY_TIMEOUT = 5.0
+
+# plain client that collects whatever the server sends back per stream, so the test decides
+# exactly what goes on which stream and when it ends
+class ClientProtocol(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replies: Dict[int, asyncio.Queue] = {}
+        self.frames: Dict[int, pdu.FrameReader] = {}
+
+    def reply_queue(self, stream_id: int) -> asyncio.Queue:
+        if stream_id not in self.replies:
+            self.replies[stream_id] = asyncio.Queue()
+        return self.replies[stream_id]
+
+    def quic_event_received(self, event):
+        if isinstance(event, StreamDataReceived):
+            reader = self.frames.setdefault(event.stream_id, pdu.FrameReader())
+            for data in reader.feed(event.data):
+                self.reply_queue(event.stream_id).put_nowait(data)
+
+    def new_stream(self) -> int:
+        return self._quic.get_next_available_stream_id()
+
+    def send(self, stream_id: int, data: bytes, end_stream: bool = False) -> None:
+        self._quic.send_stream_data(stream_id, pdu.frame(data) if data else b"", end_stream)
+        self.transmit()
+
+    async def request(self, stream_id: int, message: pdu.Message) -> pdu.Message:
+        self.send(stream_id, message.to_bytes())
+        reply = await asyncio.wait_for(self.reply_queue(stream_id).get(), timeout=REPLY_TIMEOUT)
+        return pdu.Message.from_bytes(reply)
+
+    async def login(self, username: str, password: str):
+        stream_id = self.new_stream()
+        response = await self.request(stream_id, pdu.login_request(username, password))
+        assert response.mtype == pdu.LOGIN_RESPONSE and response.payload["auth"] == 0
+        return stream_id, response.payload["id"]
+
+# an AsyncQuicServer on a free port, yields the server and the port
+@contextlib.asynccontextmanager
+async def running_server(cert_files):
+    cert_file, key_file = cert_files
+    configuration = quic_engine.build_server_quic_config(cert_file, key_file)
+    server = await quic_engine.serve_drainable("127.0.0.1", 0, configuration=configuration,
+                                               create_protocol=quic_engine.AsyncQuicServer)
+    try:
+        yield server, server._transport.get_extra_info("sockname")[1]
+    finally:
+        server.close()
+        await asyncio.sleep(0)
+
+# connects a ClientProtocol to the server on port
+def client(cert_files, port):
+    configuration = quic_engine.build_client_quic_config(cert_files[0])
+    configuration.server_name = "localhost"
+    return connect("127.0.0.1", port, configuration=configuration, create_protocol=ClientProtocol)
+
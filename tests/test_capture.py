@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import capture
+import pdu
+from capture import REDACTED_PASSWORD, TrafficCapture, decode_pdu, load_capture, redact
+
+def test_redact_blanks_login_passwords_only():
+    login = decode_pdu(pdu.login_request("user1", "pass1").to_bytes())
+    redacted = redact(login)
+    assert redacted["payload"] == {"username": "user1", "password": REDACTED_PASSWORD}
+    assert login["payload"]["password"] == "pass1"
+
+    chat = decode_pdu(pdu.chat_message(1, 0, 'my "password" is hunter2').to_bytes())
+    assert redact(chat) == chat
+
+# PDUs that don't decode, or are shaped wrong, are stored as they came in
+def test_redact_leaves_anything_else_alone():
+    assert redact(decode_pdu(b"not a pdu")) == "not a pdu"
+    assert redact(decode_pdu(b'[1, "password"]')) == [1, "password"]
+    odd_login = {"mtype": pdu.LOGIN_REQUEST, "payload": ["password"]}
+    assert redact(odd_login) == odd_login
+
+# records are only written when flushed, "p" holds the PDU as an object and close() writes
+# out whatever was still waiting
+def test_capture_is_written_in_batches(tmp_path):
+    path = tmp_path / "capture.jsonl"
+
+    async def run():
+        traffic = TrafficCapture(str(path))
+        traffic.record(1, 0, capture.DIRECTION_IN, pdu.login_request("user1", "pass1").to_bytes())
+        traffic.record(1, 3, capture.DIRECTION_OUT, pdu.chat_message(1, 0, "hi").to_bytes(), reply_to=0)
+        assert path.read_text() == ""
+        await asyncio.sleep(capture.FLUSH_INTERVAL * 2)
+        assert len(path.read_text().splitlines()) == 2
+        traffic.record(1, None, capture.DIRECTION_IN, pdu.ping_message(1).to_bytes(), True)
+        traffic.close()
+
+    asyncio.run(run())
+    records = load_capture(str(path))[1]
+    assert [record["s"] for record in records] == [0, 3, None]
+    assert records[0]["p"]["payload"]["password"] == REDACTED_PASSWORD
+    assert records[1]["p"]["payload"]["message"] == "hi"
+    assert records[1]["r"] == 0
+    assert records[2]["g"] is True
+    assert json.loads(path.read_text().splitlines()[2])["p"]["mtype"] == pdu.PING_MESSAGE
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pdu
+import quic_engine
+from conftest import REPLY_TIMEOUT, client, running_server
+
+# just enough of a QuicConnection for datagram_fits and a handler's send. max_frame is what
+# the peer advertised, None if it didn't advertise datagram support at all
+class FakeQuic:
+    def __init__(self, max_frame=None, packet_size=1200):
+        self.configuration = SimpleNamespace(max_datagram_size=packet_size)
+        self._remote_max_datagram_frame_size = max_frame
+        self._max_datagram_size = packet_size
+        self.datagrams = []
+
+    def send_datagram_frame(self, data):
+        self.datagrams.append(data)
+
+# stands in for AsyncQuicServer, remembers what was queued for the streams
+class FakeProtocol:
+    def __init__(self):
+        self.scheduled = []
+
+    def capture(self, *args, **kwargs):
+        pass
+
+    def schedule(self, message, priority):
+        self.scheduled.append((message.stream_id, message.data))
+
+def handler_for(quic):
+    protocol = FakeProtocol()
+    handler = quic_engine.EchoServerRequestHandler(authority=None, connection=quic, protocol=protocol,
+                                                   scope={}, stream_ended=False, stream_id=0,
+                                                   transmit=lambda: None)
+    return handler, protocol
+
+def test_datagram_fits():
+    limit = 1200 - quic_engine.DATAGRAM_PACKET_OVERHEAD
+    assert not quic_engine.datagram_fits(FakeQuic(max_frame=None), b"x")
+    assert quic_engine.datagram_fits(FakeQuic(max_frame=65536), b"x" * limit)
+    assert not quic_engine.datagram_fits(FakeQuic(max_frame=65536), b"x" * (limit + 1))
+    assert not quic_engine.datagram_fits(FakeQuic(max_frame=100), b"x" * 101)
+
+def test_ping_goes_out_as_a_datagram():
+    quic = FakeQuic(max_frame=65536)
+    handler, protocol = handler_for(quic)
+    ping = pdu.ping_message(1)
+    asyncio.run(handler.send(ping.to_event(0)))
+    assert quic.datagrams == [ping.to_bytes()]
+    assert protocol.scheduled == []
+
+# a peer without datagram support gets pings on the stream instead
+def test_ping_falls_back_to_the_stream():
+    quic = FakeQuic(max_frame=None)
+    handler, protocol = handler_for(quic)
+    ping = pdu.ping_message(1)
+    asyncio.run(handler.send(ping.to_event(0)))
+    assert quic.datagrams == []
+    assert protocol.scheduled == [(0, ping.to_bytes())]
+
+# a ping datagram keeps the session alive even after the client closed every stream
+def test_server_handles_ping_datagram_without_open_streams(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            async with client(cert_files, port) as conn:
+                stream_id, client_id = await conn.login("user1", "pass1")
+                conn.send(stream_id, b"", True)
+                (server_conn,) = server.connections()
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + REPLY_TIMEOUT
+                while server_conn._handlers and loop.time() < deadline:
+                    await asyncio.sleep(0.01)
+                assert not server_conn._handlers
+
+                session = server_state.clients[client_id]
+                session.last_activity = 0
+                conn._quic.send_datagram_frame(pdu.ping_message(client_id).to_bytes())
+                conn.transmit()
+                while session.last_activity == 0 and loop.time() < deadline:
+                    await asyncio.sleep(0.01)
+                assert session.last_activity > 0
+                assert not server_conn._handlers
+
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+import asyncio
+import asyncio.events
+import sys
+from types import SimpleNamespace
+
+import loop_monitor
+from loop_monitor import LAG_BUCKETS_MS, LoopLagMonitor, describe_callback, fold_stack
+
+def test_record_lag_buckets():
+    monitor = LoopLagMonitor()
+    for lag in (0.0005, 0.001, 0.0015, 0.003, 0.3, 2.0):
+        monitor.record_lag(lag)
+    expected = [0] * (len(LAG_BUCKETS_MS) + 1)
+    for bucket in (0, 0, 1, 2, 8, len(LAG_BUCKETS_MS)):
+        expected[bucket] += 1
+    assert monitor.histogram == expected
+    assert monitor.samples == 6
+    assert monitor.max_lag == 2.0
+
+def plain_callback():
+    pass
+
+# tasks are named after their coroutine and where it is, anything else after the function
+def test_describe_callback():
+    async def waiting():
+        await asyncio.sleep(1)
+
+    async def run():
+        task = asyncio.ensure_future(waiting())
+        await asyncio.sleep(0)
+        try:
+            return describe_callback(SimpleNamespace(_callback=task.cancel))
+        finally:
+            task.cancel()
+
+    name = asyncio.run(run())
+    assert name.startswith("test_describe_callback.<locals>.waiting (")
+    assert "test_loop_monitor.py:" in name
+    assert describe_callback(SimpleNamespace(_callback=plain_callback)) == "plain_callback"
+
+def test_fold_stack():
+    def outer():
+        return inner()
+
+    def inner():
+        return sys._getframe()
+
+    folded = fold_stack(outer())
+    assert [name.split(" (")[0] for name in folded.split(";")[-3:]] == ["test_fold_stack", "outer", "inner"]
+    assert folded.split(";")[-1].startswith("inner (test_loop_monitor.py:")
+
+# stop() puts asyncio's Handle._run back, so nothing stays patched after a drain
+def test_stop_restores_the_loop():
+    original = asyncio.events.Handle._run
+
+    async def run():
+        monitor, _ = loop_monitor.arm()
+        assert asyncio.events.Handle._run is not original
+        await asyncio.sleep(loop_monitor.PROBE_INTERVAL * 2)
+        monitor.stop()
+        return monitor
+
+    monitor = asyncio.run(run())
+    assert asyncio.events.Handle._run is original
+    assert monitor.samples >= 1
@@ -0,0 +1,21 @@
+import pytest
+
+import pdu
+
+BIG = pdu.chat_message(1, 0, "x" * 6000)
+SMALL = pdu.chat_message(1, 0, "hi")
+
+def test_frames_survive_any_split():
+    data = b"".join(pdu.frame(message.to_bytes()) for message in (BIG, SMALL, SMALL))
+    for step in (1, 3, 1000, len(data)):
+        reader = pdu.FrameReader()
+        pdus = []
+        for i in range(0, len(data), step):
+            pdus += reader.feed(data[i:i + step])
+        assert pdus == [BIG.to_bytes(), SMALL.to_bytes(), SMALL.to_bytes()]
+
+def test_oversized_frames_are_refused():
+    with pytest.raises(ValueError):
+        pdu.frame(b"x" * (pdu.MAX_FRAME_SIZE + 1))
+    with pytest.raises(ValueError):
+        pdu.FrameReader().feed(pdu.FRAME_HEADER.pack(pdu.MAX_FRAME_SIZE + 1))
@@ -0,0 +1,65 @@
+import json
+
+import pdu
+from capture import DIRECTION_IN, DIRECTION_OUT
+from replay import build_script, learn_ids, rewrite_ids
+
+def as_captured(message: pdu.Message):
+    return json.loads(message.to_json())
+
+def record(direction, stream_id, message, reply_to=None):
+    captured = {"t": 0.0, "c": 1, "s": stream_id, "d": direction, "g": False, "p": message}
+    if reply_to is not None:
+        captured["r"] = reply_to
+    return captured
+
+LOGIN = as_captured(pdu.login_request("user1", "<redacted>"))
+LOGGED_IN = as_captured(pdu.login_response(0, 7))
+CHAT = as_captured(pdu.chat_message(7, 0, "hi"))
+
+# replies count towards the PDU on the stream they answer, bulk replies on the server's own
+# stream included
+def test_build_script():
+    script = build_script([
+        record(DIRECTION_IN, 0, LOGIN),
+        record(DIRECTION_OUT, 0, LOGGED_IN),
+        record(DIRECTION_IN, 0, CHAT),
+        record(DIRECTION_OUT, 3, CHAT, reply_to=0),
+        record(DIRECTION_OUT, 8, CHAT),
+    ])
+    assert [step["pdu"] for step in script] == [LOGIN, CHAT]
+    assert [step["expect"] for step in script] == [1, 1]
+    assert script[0]["recorded_replies"] == [LOGGED_IN]
+
+# captures from before PDUs were stored as objects have them as text
+def test_build_script_reads_text_pdus():
+    script = build_script([record(DIRECTION_IN, 0, json.dumps(LOGIN)),
+                           record(DIRECTION_OUT, 0, json.dumps(LOGGED_IN))])
+    assert script[0]["pdu"] == LOGIN
+    assert script[0]["recorded_replies"] == [LOGGED_IN]
+
+def test_learn_ids():
+    id_map = {}
+    assert learn_ids(id_map, [LOGGED_IN], [pdu.login_response(0, 42).to_bytes()])
+    assert id_map == {7: 42}
+
+    assert not learn_ids({}, [LOGGED_IN], [pdu.login_response(1, -1).to_bytes()])
+    assert not learn_ids({}, [LOGGED_IN], [b"not a pdu"])
+    # replies that weren't a successful login in the capture teach us nothing
+    assert learn_ids(id_map, [CHAT, "junk", as_captured(pdu.login_response(1, -1))],
+                     [b"x", b"y", b"z"])
+    assert id_map == {7: 42}
+
+def test_rewrite_ids():
+    rewritten = pdu.Message.from_bytes(rewrite_ids(CHAT, {7: 42}))
+    assert rewritten.payload["id"] == 42
+    assert rewritten.payload["message"] == "hi"
+    assert CHAT["payload"]["id"] == 7
+    assert pdu.Message.from_bytes(rewrite_ids(CHAT, {})).payload["id"] == 7
+
+# anything without a payload we can read is sent as it was captured
+def test_rewrite_ids_leaves_odd_pdus_alone():
+    assert rewrite_ids("not a pdu", {7: 42}) == b"not a pdu"
+    assert json.loads(rewrite_ids([1, 2], {7: 42})) == [1, 2]
+    assert json.loads(rewrite_ids({"mtype": 3, "payload": "text"}, {7: 42})) == {"mtype": 3, "payload": "text"}
+    assert json.loads(rewrite_ids({"mtype": 3, "payload": {"id": [7]}}, {7: 42}))["payload"]["id"] == [7]
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import signal
+import socket
+
+import echo_client
+import quic_engine
+from conftest import REPLY_TIMEOUT, running_server
+
+# a udp port nothing is listening on, so both servers in a test can use the same one
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_until(check, timeout):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not check() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    assert check()
+
+# the real client against a real server that gets SIGTERM: it's told to reconnect, stays away
+# for the delay it was given and then logs back in to the server that replaced the old one
+def test_client_comes_back_after_sigterm(cert_files, server_state, monkeypatch):
+    grace = 0.25
+    chatting = []
+    reconnects = []
+
+    async def get_user_input(prompt):
+        if prompt == "Username: ":
+            return "user1"
+        if prompt == "Password: ":
+            return "pass1"
+        chatting.append(asyncio.get_running_loop().time())
+        return await asyncio.get_running_loop().create_future()
+
+    handle_reconnect = echo_client.ChatClient.handle_reconnect
+
+    def record_reconnect(self, reconnect_msg, scope):
+        reconnects.append((asyncio.get_running_loop().time(), reconnect_msg.payload["delay_ms"]))
+        handle_reconnect(self, reconnect_msg, scope)
+
+    monkeypatch.setattr(echo_client, "get_user_input", get_user_input)
+    monkeypatch.setattr(echo_client.ChatClient, "handle_reconnect", record_reconnect)
+
+    async def run():
+        port = free_port()
+        server_config = quic_engine.build_server_quic_config(*cert_files)
+        client_config = quic_engine.build_client_quic_config(cert_files[0])
+        client_config.server_name = "localhost"
+
+        def start_server():
+            return asyncio.ensure_future(quic_engine.run_server("127.0.0.1", port, server_config,
+                                                                drain_window_ms=0, drain_grace=grace))
+
+        first = start_server()
+        client = asyncio.ensure_future(quic_engine.run_client("127.0.0.1", port, client_config))
+        second = None
+        try:
+            await wait_until(lambda: len(chatting) == 1, REPLY_TIMEOUT)
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(first, timeout=REPLY_TIMEOUT)
+            assert len(reconnects) == 1
+
+            second = start_server()
+            await wait_until(lambda: len(chatting) == 2, REPLY_TIMEOUT)
+            assert not client.done()
+        finally:
+            for task in (first, client, second):
+                if task is not None:
+                    task.cancel()
+            await asyncio.gather(first, client, *([second] if second else []), return_exceptions=True)
+
+    asyncio.run(run())
+    (reconnected_at, delay_ms), = reconnects
+    assert delay_ms == 2 * grace * 1000
+    assert chatting[1] - reconnected_at >= delay_ms / 1000
+
+# a draining server drops new handshakes, the client gives up on it after HANDSHAKE_TIMEOUT
+# instead of waiting for the idle timeout
+def test_handshake_to_draining_server_times_out(cert_files, server_state, monkeypatch):
+    monkeypatch.setattr(quic_engine, "HANDSHAKE_TIMEOUT", 0.3)
+
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            server.draining = True
+            configuration = quic_engine.build_client_quic_config(cert_files[0])
+            configuration.server_name = "localhost"
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            client = asyncio.ensure_future(quic_engine.run_client("127.0.0.1", port, configuration))
+            done, _ = await asyncio.wait({client}, timeout=REPLY_TIMEOUT)
+            client.cancel()
+            assert done, "client was still waiting for the handshake"
+            assert isinstance(client.exception(), asyncio.TimeoutError)
+            return loop.time() - started
+
+    assert asyncio.run(run()) < 2.0
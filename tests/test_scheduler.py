@@ -0,0 +1,196 @@
+import asyncio
+from time import perf_counter, time
+from types import SimpleNamespace
+
+from aioquic.quic.connection import stream_is_client_initiated, stream_is_unidirectional
+
+import pdu
+import quic_engine
+from echo_quic import QuicStreamEvent
+from scheduler import QUANTUM, OutboundScheduler
+from conftest import REPLY_TIMEOUT, client, running_server
+
+# just enough of a QuicConnection for the scheduler: hands out stream ids like aioquic does
+# and remembers what was written where. window, if given, is what the scheduler finds as
+# the congestion window on aioquic's recovery object
+class FakeQuic:
+    def __init__(self, is_client: bool, window=None):
+        self.configuration = SimpleNamespace(is_client=is_client)
+        self.next_uni = 2 if is_client else 3
+        self.written = []
+        if window is not None:
+            self._loss = SimpleNamespace(_cc=SimpleNamespace(congestion_window=window, bytes_in_flight=0))
+
+    def get_next_available_stream_id(self, is_unidirectional=False):
+        assert is_unidirectional
+        stream_id = self.next_uni
+        self.next_uni += 4
+        return stream_id
+
+    def send_stream_data(self, stream_id, data, end_stream=False):
+        self.written.append((stream_id, data))
+
+def write(scheduler, stream_id, message):
+    event = message.to_event(stream_id)
+    scheduler.enqueue(event, event.priority)
+    scheduler.pump()
+    stream_id, data = scheduler.quic.written[-1]
+    return stream_id, pdu.FrameReader().feed(data)
+
+BULK = pdu.chat_message(1, 0, "x" * (pdu.BULK_PAYLOAD_SIZE + 1))
+SMALL = pdu.chat_message(1, 0, "hi")
+
+def test_server_moves_bulk_to_its_own_stream():
+    quic = FakeQuic(is_client=False)
+    scheduler = OutboundScheduler(quic)
+    stream_id, pdus = write(scheduler, 0, BULK)
+    assert stream_is_unidirectional(stream_id) and not stream_is_client_initiated(stream_id)
+    assert pdus == [BULK.to_bytes()]
+    assert write(scheduler, 0, SMALL)[0] == 0
+
+def test_client_keeps_bulk_on_the_stream_it_was_sent_on():
+    quic = FakeQuic(is_client=True)
+    scheduler = OutboundScheduler(quic, remap_bulk=False)
+    assert write(scheduler, 0, BULK)[0] == 0
+
+# the client's unidirectional streams are receive only for the server, answers go out on a
+# unidirectional stream of the server's own
+def test_never_sends_on_peer_unidirectional_streams():
+    quic = FakeQuic(is_client=False)
+    scheduler = OutboundScheduler(quic)
+    stream_id, _ = write(scheduler, 2, pdu.login_response(0, 1))
+    assert stream_is_unidirectional(stream_id) and not stream_is_client_initiated(stream_id)
+
+def test_capture_sees_the_stream_written_to():
+    quic = FakeQuic(is_client=False)
+    seen = []
+    scheduler = OutboundScheduler(quic, on_write=lambda stream_id, message: seen.append((stream_id, message.stream_id)))
+    write(scheduler, 0, BULK)
+    assert seen == [(3, 0)]
+
+# one QUANTUM sized PDU per priority class, on stream 0 so nothing gets moved around
+def queued(scheduler, priority, count):
+    for _ in range(count):
+        scheduler.enqueue(QuicStreamEvent(0, bytes([priority]) * QUANTUM, False, False, priority), priority)
+
+def written_classes(quic):
+    return [pdu.FrameReader().feed(data)[0][0] for _, data in quic.written]
+
+def test_control_goes_before_queued_traffic():
+    quic = FakeQuic(is_client=False, window=3 * QUANTUM)
+    scheduler = OutboundScheduler(quic, remap_bulk=False)
+    queued(scheduler, pdu.PRIORITY_BULK, 5)
+    queued(scheduler, pdu.PRIORITY_INTERACTIVE, 5)
+    queued(scheduler, pdu.PRIORITY_CONTROL, 2)
+    scheduler.pump()
+    assert written_classes(quic)[:2] == [pdu.PRIORITY_CONTROL] * 2
+    assert pdu.PRIORITY_CONTROL not in written_classes(quic)[2:]
+
+# with both queues full, every round is 4 interactive PDUs to 1 bulk one
+def test_interactive_and_bulk_split_four_to_one():
+    quic = FakeQuic(is_client=False, window=50 * QUANTUM)
+    scheduler = OutboundScheduler(quic, remap_bulk=False)
+    queued(scheduler, pdu.PRIORITY_BULK, 100)
+    queued(scheduler, pdu.PRIORITY_INTERACTIVE, 100)
+    scheduler.pump()
+    classes = written_classes(quic)
+    assert len(classes) == 50
+    assert classes[:5] == [pdu.PRIORITY_INTERACTIVE] * 4 + [pdu.PRIORITY_BULK]
+    assert classes.count(pdu.PRIORITY_INTERACTIVE) == 4 * classes.count(pdu.PRIORITY_BULK)
+
+# only the free part of the window is handed to aioquic, and a full window still lets one
+# PDU through so the connection never stalls
+def test_pump_stays_within_the_window():
+    quic = FakeQuic(is_client=False, window=10 * QUANTUM)
+    scheduler = OutboundScheduler(quic, remap_bulk=False)
+    queued(scheduler, pdu.PRIORITY_INTERACTIVE, 30)
+
+    quic._loss._cc.bytes_in_flight = 4 * QUANTUM
+    scheduler.pump()
+    assert len(quic.written) == 6
+
+    quic._loss._cc.bytes_in_flight = 10 * QUANTUM
+    scheduler.pump()
+    assert len(quic.written) == 7
+    assert scheduler.pending()
+
+# waits for the server to open a stream of its own, returns its reply queue
+async def server_stream(conn) -> asyncio.Queue:
+    while True:
+        for stream_id, queue in conn.replies.items():
+            if not stream_is_client_initiated(stream_id):
+                return queue
+        await asyncio.sleep(0.01)
+
+# a chat on one of the client's unidirectional streams gets its echo on one of the server's
+def test_reply_to_client_unidirectional_stream(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            async with client(cert_files, port) as conn:
+                _, client_id = await conn.login("user1", "pass1")
+                uni = conn._quic.get_next_available_stream_id(is_unidirectional=True)
+                conn.send(uni, pdu.chat_message(client_id, int(time()), "one way").to_bytes())
+                replies = await asyncio.wait_for(server_stream(conn), timeout=REPLY_TIMEOUT)
+                reply = await asyncio.wait_for(replies.get(), timeout=REPLY_TIMEOUT)
+                assert pdu.Message.from_bytes(reply).payload["message"] == "one way"
+
+    asyncio.run(run())
+
+# a real client that also schedules its sends (AsyncQuicServer is the client protocol too)
+# sends a bulk chat, the server's echo has to make it back in one piece
+def test_bulk_chat_from_client_round_trips(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            configuration = quic_engine.build_client_quic_config(cert_files[0])
+            configuration.server_name = "localhost"
+            async with quic_engine.connect("127.0.0.1", port, configuration=configuration,
+                                           create_protocol=quic_engine.AsyncQuicServer) as conn:
+                handler = conn._client_handler
+                stream_id = handler.get_next_stream_id()
+
+                async def request(message):
+                    await handler.send(message.to_event(stream_id))
+                    reply = await asyncio.wait_for(handler.receive(), timeout=REPLY_TIMEOUT)
+                    return pdu.Message.from_bytes(reply.data)
+
+                login = await request(pdu.login_request("user1", "pass1"))
+                client_id = login.payload["id"]
+                text = "y" * (4 * pdu.BULK_PAYLOAD_SIZE)
+                reply = await request(pdu.chat_message(client_id, int(time()), text))
+                assert reply.mtype == pdu.CHAT_MESSAGE
+                assert reply.payload["message"] == text
+
+    asyncio.run(run())
+
+# gives the server a backlog of chat replies on the login stream, then asks for a version
+# negotiation on the same stream. the control reply has to overtake nearly all of the
+# backlog instead of arriving behind it, which is what it does without the scheduler
+def test_control_overtakes_queued_replies(cert_files, server_state):
+    backlog = 400
+    text = "z" * (pdu.BULK_PAYLOAD_SIZE // 2)
+
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            async with client(cert_files, port) as conn:
+                stream_id, client_id = await conn.login("user1", "pass1")
+                (server_conn,) = server.connections()
+                started = perf_counter()
+                for _ in range(backlog):
+                    event = pdu.chat_message(client_id, int(time()), text).to_event(stream_id)
+                    server_conn.schedule(event, event.priority)
+                server_conn.transmit()
+                conn.send(stream_id, pdu.version_request(["1.2"]).to_bytes())
+
+                overtaken = None
+                control_latency = None
+                for i in range(backlog + 1):
+                    reply = await asyncio.wait_for(conn.reply_queue(stream_id).get(), timeout=REPLY_TIMEOUT)
+                    if pdu.Message.from_bytes(reply).mtype == pdu.VERSION_RESPONSE:
+                        control_latency = perf_counter() - started
+                        overtaken = backlog - i
+                return overtaken, control_latency, perf_counter() - started
+
+    overtaken, control_latency, backlog_time = asyncio.run(run())
+    assert overtaken >= 0.9 * backlog, f"control reply only overtook {overtaken} of {backlog} queued replies"
+    assert control_latency < backlog_time / 2, \
+        f"control reply after {control_latency * 1000:.1f} ms, backlog done after {backlog_time * 1000:.1f} ms"
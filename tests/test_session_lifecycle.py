@@ -0,0 +1,205 @@
+import asyncio
+from time import time
+
+from aioquic.quic.connection import stream_is_client_initiated
+
+import echo_client
+import loopback
+import pdu
+import quic_engine
+from conftest import REPLY_TIMEOUT, client, running_server
+
+# tracks how many stream handlers and echo_server_proto tasks the server has, at most and now
+class ServerWatch:
+    def __init__(self, server: quic_engine.DrainableQuicServer):
+        self.server = server
+        self.peak_handlers = 0
+        self.peak_tasks = 0
+
+    def handlers(self) -> int:
+        return sum(len(conn._handlers) for conn in self.server.connections())
+
+    def tasks(self) -> int:
+        return sum(1 for task in asyncio.all_tasks()
+                   if not task.done() and "launch_echo" in getattr(task.get_coro(), "__qualname__", ""))
+
+    def sample(self) -> None:
+        self.peak_handlers = max(self.peak_handlers, self.handlers())
+        self.peak_tasks = max(self.peak_tasks, self.tasks())
+
+    # lets the server catch up, then returns how many handlers and tasks are left
+    async def settle(self, timeout: float = REPLY_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline and (self.handlers() or self.tasks()):
+            self.sample()
+            await asyncio.sleep(0.01)
+        return self.handlers(), self.tasks()
+
+# login, chat and logout over and over on one connection. every stream is closed by the
+# client once it's done with it, so handlers and tasks have to stay bounded and go away
+def test_handlers_bounded_over_many_sessions(cert_files, server_state):
+    cycles = 50
+
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            async with client(cert_files, port) as conn:
+                for _ in range(cycles):
+                    stream_id, client_id = await conn.login("user1", "pass1")
+                    watch.sample()
+                    for i in range(3):
+                        reply = await conn.request(stream_id, pdu.chat_message(client_id, int(time()), f"hi {i}"))
+                        assert reply.mtype == pdu.CHAT_MESSAGE
+                        watch.sample()
+                    conn.send(conn.new_stream(), pdu.logout_message(client_id).to_bytes(), True)
+                    watch.sample()
+                    conn.send(stream_id, b"", True)
+                    assert await watch.settle() == (0, 0)
+                    assert not server_state.clients and not server_state.users
+            return watch
+
+    watch = asyncio.run(run())
+    # the login/chat stream and the logout stream, never more
+    assert watch.peak_handlers <= 2
+    assert watch.peak_tasks <= 2
+
+# closing one stream with an empty FIN, or sending junk on it, only ends that stream.
+# the login lives on the connection and has to survive both
+def test_empty_fin_and_bad_pdu_keep_the_session(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            async with client(cert_files, port) as conn:
+                stream_id, client_id = await conn.login("user1", "pass1")
+
+                other = conn.new_stream()
+                reply = await conn.request(other, pdu.chat_message(client_id, int(time()), "on another stream"))
+                assert reply.mtype == pdu.CHAT_MESSAGE
+                conn.send(other, b"", True)
+
+                conn.send(conn.new_stream(), b"not a pdu", False)
+
+                # only the login stream is left, and the session is still there
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + REPLY_TIMEOUT
+                while watch.handlers() > 1 and loop.time() < deadline:
+                    await asyncio.sleep(0.01)
+                assert watch.handlers() == 1
+                assert client_id in server_state.clients
+                assert "user1" in server_state.users
+
+                reply = await conn.request(stream_id, pdu.chat_message(client_id, int(time()), "still here"))
+                assert reply.mtype == pdu.CHAT_MESSAGE
+                assert reply.payload["message"] == "still here"
+
+    asyncio.run(run())
+
+# clients that go away without logging out: every stream is woken up by ConnectionTerminated,
+# the session is removed and nothing is left running
+def test_connection_terminated_cleans_up(cert_files, server_state):
+    connections = 20
+    server_state.CREDENTIALS.update({f"gone{i}": f"pass{i}" for i in range(connections)})
+
+    async def one_client(port, i):
+        async with client(cert_files, port) as conn:
+            stream_id, client_id = await conn.login(f"gone{i}", f"pass{i}")
+            reply = await conn.request(conn.new_stream(), pdu.chat_message(client_id, int(time()), "bye"))
+            assert reply.mtype == pdu.CHAT_MESSAGE
+
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            await asyncio.gather(*(one_client(port, i) for i in range(connections)))
+            assert watch.handlers() > 0
+            assert await watch.settle() == (0, 0)
+            assert not server_state.clients and not server_state.users
+
+    asyncio.run(run())
+
+# waits until check() is true, gives up after REPLY_TIMEOUT
+async def eventually(check) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + REPLY_TIMEOUT
+    while not check() and loop.time() < deadline:
+        await asyncio.sleep(0.01)
+    return check()
+
+# logs in and closes the login stream, so the server has no handler left for the connection
+async def login_and_close_streams(conn, watch, username, password):
+    stream_id, client_id = await conn.login(username, password)
+    conn.send(stream_id, b"", True)
+    assert await eventually(lambda: watch.handlers() == 0)
+    return client_id
+
+# the session belongs to the connection, not its streams. closing every stream keeps it,
+# closing the connection ends it right away so the same user can login again
+def test_session_ends_with_the_connection_not_its_streams(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            async with client(cert_files, port) as conn:
+                client_id = await login_and_close_streams(conn, watch, "user1", "pass1")
+                assert client_id in server_state.clients
+
+            assert await eventually(lambda: not server_state.clients and not server_state.users)
+            async with client(cert_files, port) as conn:
+                await conn.login("user1", "pass1")
+
+    asyncio.run(run())
+
+# a drain still tells a client with no open streams to reconnect, on a stream of the server's
+def test_drain_reaches_connection_without_open_streams(cert_files, server_state):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            async with client(cert_files, port) as conn:
+                await login_and_close_streams(conn, watch, "user1", "pass1")
+                drain = asyncio.ensure_future(quic_engine.drain_server(server, 1000, 0, 1.0))
+
+                assert await eventually(lambda: any(not stream_is_client_initiated(stream_id)
+                                                    for stream_id in conn.replies))
+                stream_id = next(stream_id for stream_id in conn.replies
+                                 if not stream_is_client_initiated(stream_id))
+                reply = await asyncio.wait_for(conn.reply_queue(stream_id).get(), timeout=REPLY_TIMEOUT)
+                message = pdu.Message.from_bytes(reply)
+                assert message.mtype == pdu.RECONNECT_MESSAGE
+                assert message.payload["delay_ms"] == 1000
+                await drain
+
+    asyncio.run(run())
+
+# the real echo_client_proto, with the user's typing coming from a list. the version stream
+# is closed once it's answered, so while chatting only the login stream is open
+def test_real_client_only_keeps_its_chat_stream(cert_files, server_state, monkeypatch):
+    async def run():
+        async with running_server(cert_files) as (server, port):
+            watch = ServerWatch(server)
+            handlers_while_chatting = []
+            lines = iter(["user1", "pass1", "hello", "!exit"])
+
+            async def typed(prompt):
+                line = next(lines)
+                if line == "!exit":
+                    handlers_while_chatting.append(watch.handlers())
+                return line
+
+            monkeypatch.setattr(echo_client, "get_user_input", typed)
+            configuration = quic_engine.build_client_quic_config(cert_files[0])
+            configuration.server_name = "localhost"
+            await asyncio.wait_for(quic_engine.run_client("127.0.0.1", port, configuration),
+                                   timeout=REPLY_TIMEOUT)
+
+            assert handlers_while_chatting == [1]
+            assert await watch.settle() == (0, 0)
+            assert not server_state.clients and not server_state.users
+
+    asyncio.run(run())
+
+# same checks against the in-memory loopback the protocol benchmark runs on
+def test_loopback_benchmark_cleans_up(server_state):
+    report = asyncio.run(loopback.run_benchmark(clients=200, messages=3))
+    assert report["failed_clients"] == 0
+    assert report["peak_server_tasks_per_client"] <= 2
+    assert report["server_tasks_left"] == 0
+    assert report["sessions_left"] == 0
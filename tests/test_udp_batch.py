@@ -0,0 +1,117 @@
+import asyncio
+import errno
+import socket
+
+import pytest
+
+import udp_batch
+
+# every combination of send paths the transport can end up on
+MODES = [
+    {"use_mmsg": True, "use_gso": True},
+    {"use_mmsg": True, "use_gso": False},
+    {"use_mmsg": False, "use_gso": True},
+    {"use_mmsg": False, "use_gso": False}
+]
+
+# sending to the broadcast address without SO_BROADCAST fails with EACCES
+BAD_ADDR = ("255.255.255.255", 9)
+
+class RecordingProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.errors = []
+
+    def error_received(self, exc):
+        self.errors.append(exc)
+
+def receive_all(sock):
+    received = []
+    while True:
+        try:
+            received.append(sock.recv(65535))
+        except BlockingIOError:
+            return received
+
+async def send_and_collect(datagrams, **options):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setblocking(False)
+    good = receiver.getsockname()
+    transport, protocol = await udp_batch.create_batched_datagram_endpoint(
+        RecordingProtocol, ("127.0.0.1", 0), **options)
+    try:
+        for data, to_good in datagrams:
+            transport.sendto(data, good if to_good else BAD_ADDR)
+        await asyncio.sleep(0.1)
+        return receive_all(receiver), protocol.errors
+    finally:
+        transport.close()
+        await asyncio.sleep(0)
+        receiver.close()
+
+@pytest.mark.parametrize("options", MODES)
+def test_failed_datagram_does_not_drop_the_rest(options):
+    received, errors = asyncio.run(send_and_collect(
+        [(b"first", True), (b"lost", False), (b"last", True)], **options))
+    assert received == [b"first", b"last"]
+    assert len(errors) == 1
+
+# same sized datagrams to one peer go out as a GSO run, a bad one in the middle of a run of
+# its own shouldn't take the good runs around it down with it
+@pytest.mark.parametrize("options", MODES)
+def test_failed_run_does_not_drop_the_rest(options):
+    datagrams = ([(b"a" * 100, True)] * 3 + [(b"b" * 100, False)] * 3 + [(b"c" * 100, True)] * 3)
+    received, errors = asyncio.run(send_and_collect(datagrams, **options))
+    assert received == [b"a" * 100] * 3 + [b"c" * 100] * 3
+    assert len(errors) == 3
+    assert all(e.errno == errno.EACCES for e in errors)
+
+def test_bind_tries_every_address(monkeypatch):
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        # first address isn't on this host, so binding it fails
+        async def getaddrinfo(host, port, **kwargs):
+            return [
+                (socket.AF_INET, socket.SOCK_DGRAM, 0, "", ("192.0.2.1", 0)),
+                (socket.AF_INET, socket.SOCK_DGRAM, 0, "", ("127.0.0.1", 0))
+            ]
+
+        monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+        transport, _ = await udp_batch.create_batched_datagram_endpoint(
+            RecordingProtocol, ("example", 0))
+        sockname = transport.get_extra_info("sockname")
+        transport.close()
+        await asyncio.sleep(0)
+        return sockname
+
+    assert asyncio.run(run())[0] == "127.0.0.1"
+
+def test_bind_raises_when_nothing_binds(monkeypatch):
+    async def run():
+        loop = asyncio.get_running_loop()
+
+        async def getaddrinfo(host, port, **kwargs):
+            return [(socket.AF_INET, socket.SOCK_DGRAM, 0, "", ("192.0.2.1", 0))]
+
+        monkeypatch.setattr(loop, "getaddrinfo", getaddrinfo)
+        await udp_batch.create_batched_datagram_endpoint(RecordingProtocol, ("example", 0))
+
+    with pytest.raises(OSError):
+        asyncio.run(run())
+
+def test_connection_made_before_endpoint_returns():
+    class Protocol(RecordingProtocol):
+        transport = None
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+    async def run():
+        transport, protocol = await udp_batch.create_batched_datagram_endpoint(Protocol, ("127.0.0.1", 0))
+        made = protocol.transport is transport
+        transport.close()
+        await asyncio.sleep(0)
+        return made
+
+    assert asyncio.run(run())
@@ -0,0 +1,476 @@
+import argparse
+import asyncio
+import ctypes
+import errno
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+# linux socket options for UDP segmentation offload, not every python exposes these names
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+
+# how many datagrams we move per syscall, and the limits the kernel puts on a GSO send
+BATCH_SIZE = 64
+MAX_GSO_SEGMENTS = 64
+MAX_GSO_BYTES = 65000
+RECV_BUFFER_SIZE = 65535
+CONTROL_BUFFER_SIZE = 64
+SOCKADDR_SIZE = 128
+
+# errors a GSO send fails with when the route or device can't segment, anything else is
+# about the datagrams themselves and gets handled like a plain send would
+GSO_UNSUPPORTED_ERRORS = (errno.EIO, errno.EINVAL, errno.EOPNOTSUPP)
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+# looks up recvmmsg/sendmmsg in libc, these only exist on linux (and a couple of BSDs)
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, "recvmmsg") or not hasattr(libc, "sendmmsg"):
+        return None
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                              ctypes.c_int, ctypes.c_void_p]
+    libc.recvmmsg.restype = ctypes.c_int
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    libc.sendmmsg.restype = ctypes.c_int
+    return libc
+
+_libc = _load_libc()
+
+# converts between python address tuples and raw sockaddr bytes, in the same shape
+# socket.recvfrom gives back so aioquic can compare addresses like it normally does
+def parse_sockaddr(raw: bytes):
+    family = struct.unpack_from("=H", raw, 0)[0]
+    port = struct.unpack_from("!H", raw, 2)[0]
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(socket.AF_INET, raw[4:8]), port)
+    flowinfo = struct.unpack_from("!I", raw, 4)[0]
+    scope_id = struct.unpack_from("=I", raw, 24)[0]
+    return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id)
+
+def build_sockaddr(family: int, addr) -> bytes:
+    if family == socket.AF_INET:
+        return (struct.pack("=H", socket.AF_INET) + struct.pack("!H", addr[1])
+                + socket.inet_pton(socket.AF_INET, addr[0]) + bytes(8))
+    flowinfo = addr[2] if len(addr) > 2 else 0
+    scope_id = addr[3] if len(addr) > 3 else 0
+    return (struct.pack("=H", socket.AF_INET6) + struct.pack("!HI", addr[1], flowinfo)
+            + socket.inet_pton(socket.AF_INET6, addr[0].split("%")[0]) + struct.pack("=I", scope_id))
+
+# pulls the GRO segment size out of a control buffer, 0 if the kernel didn't coalesce anything.
+# cmsghdr is {size_t len; int level; int type;} followed by the data, padded to size_t
+def parse_gro_segment(control: bytes) -> int:
+    header = struct.calcsize("=Nii")
+    align = ctypes.sizeof(ctypes.c_size_t)
+    offset = 0
+    while offset + header <= len(control):
+        length, level, ctype = struct.unpack_from("=Nii", control, offset)
+        if length < header:
+            break
+        if level == SOL_UDP and ctype == UDP_GRO:
+            return struct.unpack_from("=i", control, offset + header)[0]
+        offset += (length + align - 1) & ~(align - 1)
+    return 0
+
+# splits a GRO coalesced buffer back into the datagrams the peer sent
+def split_segments(data: bytes, segment: int) -> List[bytes]:
+    if segment <= 0 or segment >= len(data):
+        return [data]
+    return [data[i:i + segment] for i in range(0, len(data), segment)]
+
+# groups queued datagrams into GSO sends: back to back datagrams to the same address with the
+# same size, where only the last one may be shorter. returns (payloads, addr) per send
+def plan_gso(pending: List[Tuple[bytes, tuple]]) -> List[Tuple[List[bytes], tuple]]:
+    plan: List[Tuple[List[bytes], tuple]] = []
+    for data, addr in pending:
+        if plan:
+            run, run_addr = plan[-1]
+            size = len(run[0])
+            if (run_addr == addr and len(run) < MAX_GSO_SEGMENTS and len(run[-1]) == size
+                    and len(data) <= size and sum(map(len, run)) + len(data) <= MAX_GSO_BYTES):
+                run.append(data)
+                continue
+        plan.append(([data], addr))
+    return plan
+
+# preallocated recvmmsg buffers, reused for every batch
+class _MmsgReceiver:
+    def __init__(self, batch: int = BATCH_SIZE):
+        self.batch = batch
+        self.buffers = ((ctypes.c_char * RECV_BUFFER_SIZE) * batch)()
+        self.names = ((ctypes.c_char * SOCKADDR_SIZE) * batch)()
+        self.controls = ((ctypes.c_char * CONTROL_BUFFER_SIZE) * batch)()
+        self.iovecs = (iovec * batch)()
+        self.msgs = (mmsghdr * batch)()
+        for i in range(batch):
+            self.iovecs[i].iov_base = ctypes.addressof(self.buffers[i])
+            self.iovecs[i].iov_len = RECV_BUFFER_SIZE
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.names[i])
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = ctypes.addressof(self.controls[i])
+
+    # returns (data, addr) pairs, an empty list once the socket is drained
+    def recv(self, fd: int, gro: bool) -> List[Tuple[bytes, tuple]]:
+        for i in range(self.batch):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_namelen = SOCKADDR_SIZE
+            hdr.msg_controllen = CONTROL_BUFFER_SIZE if gro else 0
+            hdr.msg_flags = 0
+        count = _libc.recvmmsg(fd, self.msgs, self.batch, MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        received = []
+        for i in range(count):
+            hdr = self.msgs[i].msg_hdr
+            data = ctypes.string_at(ctypes.addressof(self.buffers[i]), self.msgs[i].msg_len)
+            addr = parse_sockaddr(ctypes.string_at(hdr.msg_name, hdr.msg_namelen))
+            segment = 0
+            if gro and hdr.msg_controllen:
+                segment = parse_gro_segment(ctypes.string_at(hdr.msg_control, hdr.msg_controllen))
+            for part in split_segments(data, segment):
+                received.append((part, addr))
+        return received
+
+# sends a list of datagrams with one sendmmsg call, returns how many the kernel took
+def _sendmmsg(fd: int, family: int, datagrams: List[Tuple[bytes, tuple]]) -> int:
+    count = len(datagrams)
+    msgs = (mmsghdr * count)()
+    iovecs = (iovec * count)()
+    keep = []
+    for i, (data, addr) in enumerate(datagrams):
+        buffer = ctypes.create_string_buffer(data, len(data))
+        raw_name = build_sockaddr(family, addr)
+        name = ctypes.create_string_buffer(raw_name, len(raw_name))
+        keep.append((buffer, name))
+        iovecs[i].iov_base = ctypes.addressof(buffer)
+        iovecs[i].iov_len = len(data)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(name)
+        hdr.msg_namelen = len(name.raw)
+        hdr.msg_iov = ctypes.pointer(iovecs[i])
+        hdr.msg_iovlen = 1
+    sent = _libc.sendmmsg(fd, msgs, count, MSG_DONTWAIT)
+    if sent < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return 0
+        raise OSError(err, os.strerror(err))
+    return sent
+
+def _set_result_unless_cancelled(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.set_result(None)
+
+# datagram transport that batches syscalls. sendto only queues the datagram, and everything
+# queued during one loop iteration goes out together once it's done, using GSO for runs of
+# same sized datagrams to one peer and sendmmsg for the rest. reads drain the socket with
+# recvmmsg, splitting GRO coalesced buffers back up. anything the platform doesn't support
+# falls back to plain sendto/recvfrom, just still batched per loop iteration
+class BatchedDatagramTransport(asyncio.DatagramTransport):
+    def __init__(self, loop, sock: socket.socket, protocol: asyncio.DatagramProtocol,
+                 use_gso: bool = True, use_gro: bool = True, use_mmsg: bool = True,
+                 waiter: Optional[asyncio.Future] = None):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._family = sock.family
+        self._protocol = protocol
+        self._pending: List[Tuple[bytes, tuple]] = []
+        self._flush_scheduled = False
+        self._waiting_writable = False
+        self._closing = False
+        self._extra = {"socket": sock, "sockname": sock.getsockname()}
+
+        self.mmsg = use_mmsg and _libc is not None
+        self.gso = use_gso and self._probe_option(UDP_SEGMENT, None)
+        self.gro = use_gro and self.mmsg and self._probe_option(UDP_GRO, 1)
+        self._receiver = _MmsgReceiver() if self.mmsg else None
+        self.stats = {"rx_packets": 0, "rx_syscalls": 0, "tx_packets": 0, "tx_syscalls": 0}
+
+        self._loop.call_soon(self._protocol.connection_made, self)
+        self._loop.call_soon(self._loop.add_reader, self._fd, self._on_readable)
+        if waiter is not None:
+            self._loop.call_soon(_set_result_unless_cancelled, waiter)
+
+    # GSO is checked by reading the option, GRO has to be switched on
+    def _probe_option(self, option: int, value: Optional[int]) -> bool:
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            if value is None:
+                self._sock.getsockopt(SOL_UDP, option)
+            else:
+                self._sock.setsockopt(SOL_UDP, option, value)
+            return True
+        except OSError:
+            return False
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def get_protocol(self):
+        return self._protocol
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def sendto(self, data, addr=None) -> None:
+        if self._closing:
+            return
+        self._pending.append((bytes(data), addr))
+        if not self._flush_scheduled and not self._waiting_writable:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _on_readable(self) -> None:
+        for _ in range(BATCH_SIZE):
+            try:
+                if self._receiver is not None:
+                    received = self._receiver.recv(self._fd, self.gro)
+                else:
+                    try:
+                        received = [self._sock.recvfrom(RECV_BUFFER_SIZE)]
+                    except (BlockingIOError, InterruptedError):
+                        received = []
+            except OSError as e:
+                self._protocol.error_received(e)
+                return
+            if not received:
+                return
+            self.stats["rx_syscalls"] += 1
+            self.stats["rx_packets"] += len(received)
+            for data, addr in received:
+                self._protocol.datagram_received(data, addr)
+
+    def _on_writable(self) -> None:
+        self._loop.remove_writer(self._fd)
+        self._waiting_writable = False
+        self._flush()
+
+    # sends one GSO run, returns how many datagrams went out (0 if the socket is full)
+    def _send_gso(self, run: List[bytes], addr) -> int:
+        try:
+            self._sock.sendmsg([b"".join(run)], [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", len(run[0])))],
+                               0, addr)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        self.stats["tx_syscalls"] += 1
+        self.stats["tx_packets"] += len(run)
+        return len(run)
+
+    # sends datagrams from the front of the list, returns how many went out (0 if the socket
+    # is full). raises if the first one can't be sent, sendmmsg only reports errors that way
+    def _send_plain(self, datagrams: List[Tuple[bytes, tuple]]) -> int:
+        if self.mmsg:
+            sent = _sendmmsg(self._fd, self._family, datagrams)
+            if sent:
+                self.stats["tx_syscalls"] += 1
+            self.stats["tx_packets"] += sent
+            return sent
+        try:
+            self._sock.sendto(*datagrams[0])
+        except (BlockingIOError, InterruptedError):
+            return 0
+        self.stats["tx_syscalls"] += 1
+        self.stats["tx_packets"] += 1
+        return 1
+
+    # sends from the front of the batch with one syscall, GSO if it starts with a run of
+    # same sized datagrams and plain otherwise. same return value and errors as _send_plain
+    def _send_batch(self, batch: List[Tuple[bytes, tuple]]) -> int:
+        if self.gso:
+            plan = plan_gso(batch)
+            run, addr = plan[0]
+            if len(run) > 1:
+                try:
+                    return self._send_gso(run, addr)
+                except OSError as e:
+                    if e.errno in GSO_UNSUPPORTED_ERRORS:
+                        self.gso = False
+                # send the run plain, so if one of them is the problem only that one is lost
+                return self._send_plain([(data, addr) for data in run])
+            # plain datagrams up to where the next run starts
+            batch = []
+            for run, addr in plan:
+                if len(run) > 1:
+                    break
+                batch.append((run[0], addr))
+        return self._send_plain(batch)
+
+    def _flush(self) -> None:
+        self._flush_scheduled = False
+        while self._pending:
+            try:
+                sent = self._send_batch(self._pending[:BATCH_SIZE])
+            except OSError as e:
+                # only the datagram at the front failed (EPERM, ENETUNREACH, EMSGSIZE...),
+                # drop that one and keep going with the rest
+                del self._pending[0]
+                self._protocol.error_received(e)
+                continue
+            if sent == 0:
+                break
+            del self._pending[:sent]
+
+        # the socket buffer is full, pick up where we left off once it drains
+        if self._pending and not self._waiting_writable:
+            self._waiting_writable = True
+            self._loop.add_writer(self._fd, self._on_writable)
+
+    def close(self) -> None:
+        if self._closing:
+            return
+        self._closing = True
+        self._flush()
+        self._loop.remove_reader(self._fd)
+        if self._waiting_writable:
+            self._loop.remove_writer(self._fd)
+        self._loop.call_soon(self._connection_lost)
+
+    def abort(self) -> None:
+        self._pending.clear()
+        self.close()
+
+    def _connection_lost(self) -> None:
+        try:
+            self._protocol.connection_lost(None)
+        finally:
+            self._sock.close()
+
+# same idea as loop.create_datagram_endpoint(protocol_factory, local_addr=...), but backed
+# by a BatchedDatagramTransport. like the stock one, every address the name resolves to is
+# tried in turn and the first error is raised if none of them can be bound
+async def create_batched_datagram_endpoint(protocol_factory, local_addr, **options):
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(local_addr[0], local_addr[1], type=socket.SOCK_DGRAM)
+    if not infos:
+        raise OSError(f"getaddrinfo({local_addr[0]!r}) returned empty list")
+    exceptions = []
+    for family, _, proto, _, sockaddr in infos:
+        sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+        try:
+            sock.setblocking(False)
+            sock.bind(sockaddr)
+        except OSError as e:
+            sock.close()
+            exceptions.append(e)
+            continue
+        protocol = protocol_factory()
+        # the protocol has seen connection_made by the time we return, same as the stock one
+        waiter = loop.create_future()
+        transport = BatchedDatagramTransport(loop, sock, protocol, waiter=waiter, **options)
+        try:
+            await waiter
+        except BaseException:
+            transport.close()
+            raise
+        return transport, protocol
+    raise exceptions[0]
+
+# packets per second benchmark: an echo endpoint on loopback, with client processes firing
+# windows of datagrams at it and counting how many come back
+class _EchoProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+def _blast(addr, seconds: float, window: int, size: int, results) -> None:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    payload = bytes(size)
+    sent = echoed = 0
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        for _ in range(window):
+            sock.sendto(payload, addr)
+        sent += window
+        for _ in range(window):
+            try:
+                sock.recv(RECV_BUFFER_SIZE)
+                echoed += 1
+            except socket.timeout:
+                break
+    sock.close()
+    results.put((sent, echoed))
+
+async def benchmark_endpoint(batched: bool, seconds: float, clients: int, window: int, size: int) -> dict:
+    loop = asyncio.get_running_loop()
+    if batched:
+        transport, _ = await create_batched_datagram_endpoint(_EchoProtocol, ("127.0.0.1", 0))
+    else:
+        transport, _ = await loop.create_datagram_endpoint(_EchoProtocol, local_addr=("127.0.0.1", 0))
+    addr = transport.get_extra_info("sockname")
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_blast, args=(addr, seconds, window, size, results))
+               for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    totals = [await loop.run_in_executor(None, results.get) for _ in workers]
+    for worker in workers:
+        await loop.run_in_executor(None, worker.join)
+
+    report = {
+        "endpoint": "batched" if batched else "stock",
+        "sent": sum(sent for sent, _ in totals),
+        "echoed": sum(echoed for _, echoed in totals),
+        "echoed_pps": round(sum(echoed for _, echoed in totals) / seconds, 1)
+    }
+    if batched:
+        report.update(transport.stats)
+        report.update({"mmsg": transport.mmsg, "gso": transport.gso, "gro": transport.gro})
+    transport.close()
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Packets per second benchmark, batched vs stock UDP endpoint')
+    parser.add_argument('--seconds', type=float, default=5, help='How long each endpoint is tested')
+    parser.add_argument('--clients', type=int, default=4, help='Number of client processes')
+    parser.add_argument('--window', type=int, default=32, help='Datagrams each client keeps in flight')
+    parser.add_argument('--size', type=int, default=1200, help='Datagram size in bytes')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    for batched in (False, True):
+        report = asyncio.run(benchmark_endpoint(batched, args.seconds, args.clients, args.window, args.size))
+        print(f"[udp] {report}")